@@ -0,0 +1,97 @@
+# ReplayECU
+# Plays a capture back through the python-isotp-mbe class, as fast as possible or in real time
+# Gives a repeatable benchmark of the whole poll/decode path without needing a car
+#
+
+import logging
+import argparse
+import pprint
+import time
+import mbe
+import mbedb
+import mbereplay
+
+version = "0.1"
+
+def main():
+	parser = argparse.ArgumentParser(prog='ReplayECU', description='Replays the ECU responses from a pcap (or an index saved by --save-index) through the mbe class and reports how fast it went.')
+	parser.add_argument('--input',         '-i',                   help='Input pcapng or exchange index filename', required=True)
+	parser.add_argument('--variables',     '-v',                   help='Input MBE variables filename', required=True)
+	parser.add_argument('--query_id',      '-q',                   help='CAN query ID (default 0x0cbe1101)', type=lambda x: int(x, 0), default=0x0cbe1101)
+	parser.add_argument('--response_id',   '-r',                   help='CAN response ID (default 0x0cbe0111)', type=lambda x: int(x, 0), default=0x0cbe0111)
+	parser.add_argument('--cycles',        '-n',                   help='Number of times to poll every page (default 1000)', type=int, default=1000)
+	parser.add_argument('--realtime',      '-t', action='store_true', help='Wait as long as the ECU took to respond in the capture')
+	parser.add_argument('--speed',         '-s',                   help='Speed up real time replay by this factor (default 1.0)', type=float, default=1.0)
+	parser.add_argument('--pipeline',      '-p',                   help='Pipeline depth (default 0, no pipelining)', type=int, default=0)
+	parser.add_argument('--save-index',    '-x',                   help='Save the exchanges found in the input to this index file for quicker loading next time')
+	parser.add_argument('--loglevel',      '-l',                   help='Logging level to show', choices=['INFO','DEBUG','WARNING', 'ERROR', 'NONE'], default="ERROR")
+	parser.add_argument('--logfile',       '-f',                   help='If set logging will be sent to this file')
+	parser.add_argument('--output',        '-o',                   help='If set polled data will be logged to this file (see mbelog.py)')
+	parser.add_argument('--version',       '-V', action='version', version='%(prog)s '+version)
+
+	args = parser.parse_args()
+
+	logging_level = getattr(logging, args.loglevel, None)
+	logging.basicConfig(level=logging_level, filename=args.logfile, filemode='w')
+
+	exchanges = mbereplay.load(args.input, args.query_id, args.response_id)
+	if (len(exchanges) == 0):
+		logging.error(f"No data requests found in {args.input}")
+		exit()
+
+	if (args.save_index != None):
+		mbereplay.save_exchanges(exchanges, args.save_index)
+
+	ecu = mbe.mbe()
+
+	ret = ecu.set_options(args.variables, args.query_id, args.response_id)
+	if(not ret):
+		logging.error("Unable to set options")
+		exit()
+
+	if (args.pipeline > 0 and not ecu.set_pipeline_depth(args.pipeline)):
+		logging.error("Unable to set pipeline depth")
+		exit()
+
+	# Follow whatever the capture was following so our requests match the captured ones
+	variables_to_follow = mbereplay.variables_from_exchanges(exchanges, mbedb.PageIndex.from_variables(ecu.ecu_variables))
+	followed = ecu.follow(variables_to_follow)
+	if (len(followed['added']) == 0):
+		logging.error("None of the variables in the capture could be followed")
+		exit()
+
+	transport = mbereplay.ReplayTransport(exchanges, args.realtime, args.speed)
+	ecu.bind(transport)
+
+	if (args.output != None and not ecu.enable_logging(args.output)):
+		logging.error("Unable to log polled data")
+		exit()
+
+	results = dict()
+	cycles = 0
+	start = time.perf_counter()
+
+	for cycle in range(args.cycles):
+		if (ecu.process_all_pages(results) == False):
+			logging.error(f"Polling failed on cycle {cycle}")
+			break
+		cycles = cycles + 1
+
+	elapsed = time.perf_counter() - start
+
+	# Only count the samples that were actually decoded, unanswered requests don't produce any
+	samples = sum(report['samples'] for report in ecu.get_rate_report().values())
+
+	ecu.stop_logging()
+
+	logging.debug(pprint.pformat(results))
+
+	print(f"{len(exchanges)} exchanges, {len(followed['added'])} variables, {transport.unanswered} unanswered requests")
+	if (cycles == 0):
+		print("No cycles were polled")
+		return
+
+	print(f"{cycles} cycles in {elapsed:.3f}s: {cycles / elapsed:.1f} cycles/s, {samples / elapsed:.1f} samples/s")
+
+if __name__ == '__main__':
+	main()
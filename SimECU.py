@@ -0,0 +1,69 @@
+# SimECU
+# Runs a simulated 9A4 ECU on a CAN interface so pollers can be load tested without a car
+# e.g. on a plain Linux box:
+#   sudo ip link add dev vcan0 type vcan && sudo ip link set up vcan0
+#   python SimECU.py -i vcan0 -v ec2/9A4be52a.ec2.utf8.json -L 0.002 -J 0.001 -s RT_ENGINESPEED=3000
+#
+
+import logging
+import argparse
+import threading
+import mbe
+import mbetransport
+
+version = "0.1"
+
+def main():
+	parser = argparse.ArgumentParser(prog='SimECU', description='Answers MBE data requests on a CAN interface from the variables file.')
+	parser.add_argument('--interface',     '-i',                   help='The can interface to open', required=True)
+	parser.add_argument('--variables',     '-v',                   help='Input MBE variables filename', required=True)
+	parser.add_argument('--query_id',      '-q',                   help='CAN query ID (default 0x0cbe1101)', type=lambda x: int(x, 0), default=0x0cbe1101)
+	parser.add_argument('--response_id',   '-r',                   help='CAN response ID (default 0x0cbe0111)', type=lambda x: int(x, 0), default=0x0cbe0111)
+	parser.add_argument('--transport',     '-t',                   help='Kernel ISOTP socket or python-can (default socket)', choices=['socket', 'canstack'], default='socket')
+	parser.add_argument('--bustype',       '-b',                   help='python-can interface type for the canstack transport (default socketcan)', default='socketcan')
+	parser.add_argument('--latency',       '-L',                   help='Seconds the ECU takes to respond (default 0)', type=float, default=0.0)
+	parser.add_argument('--jitter',        '-J',                   help='Responses take latency +/- up to this many seconds (default 0)', type=float, default=0.0)
+	parser.add_argument('--set',           '-s', action='append',  help='NAME=VALUE, set a variable (can be repeated)', default=[])
+	parser.add_argument('--loglevel',      '-l',                   help='Logging level to show', choices=['INFO','DEBUG','WARNING', 'ERROR', 'NONE'], default="ERROR")
+	parser.add_argument('--logfile',       '-f',                   help='If set logging will be sent to this file')
+	parser.add_argument('--version',       '-V', action='version', version='%(prog)s '+version)
+
+	args = parser.parse_args()
+
+	logging_level = getattr(logging, args.loglevel, None)
+	logging.basicConfig(level=logging_level, filename=args.logfile, filemode='w')
+
+	variables = mbe.mbe().load_mbe_variables(args.variables)
+	if (variables == False):
+		logging.error("Unable to load variables")
+		exit()
+
+	ecu = mbetransport.SimulatedECU(variables, args.latency, args.jitter)
+
+	for setting in args.set:
+		name, _, value = setting.partition('=')
+		if (not ecu.set_value(name, float(value))):
+			exit()
+
+	# We're the ECU so we listen on the query ID and answer on the response ID
+	try:
+		if (args.transport == 'socket'):
+			transport = mbetransport.SocketTransport(args.interface, args.query_id, args.response_id)
+		else:
+			transport = mbetransport.CanStackTransport(args.interface, args.query_id, args.response_id, args.bustype)
+	except OSError as e:
+		logging.error(f"Unable to open the {args.transport} transport on {args.interface}: {e}")
+		exit()
+
+	stop = threading.Event()
+	try:
+		ecu.serve(transport, stop)
+	except KeyboardInterrupt:
+		stop.set()
+	finally:
+		transport.close()
+
+	print(f"Answered {ecu.requests} requests")
+
+if __name__ == '__main__':
+	main()
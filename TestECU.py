@@ -13,6 +13,7 @@ import pprint
 import pyshark
 import binascii
 import mbe
+import mbetransport
 import curses
 
 version = "0.1"
@@ -62,6 +63,9 @@ def main():
 	parser.add_argument('--response_id',   '-r',                   help='CAN resdponse ID (default 0x0cbe0111', default=0x0cbe0111)
 	parser.add_argument('--loglevel',      '-l',                   help='Logging level to show', choices=['INFO','DEBUG','WARNING', 'ERROR', 'NONE'], default="ERROR")
 	parser.add_argument('--logfile',       '-f',                   help='If set logging will be sent to this file')
+	parser.add_argument('--transport',     '-t',                   help='How to talk to the ECU (default the kernel ISOTP socket, or test data in test mode)', choices=['socket', 'canstack', 'simulator'])
+	parser.add_argument('--bustype',       '-b',                   help='python-can interface type for the canstack transport (default socketcan)', default='socketcan')
+	parser.add_argument('--output',        '-o',                   help='If set polled data will be logged to this file (see mbelog.py)')
 	parser.add_argument('--version',       '-V', action='version', version='%(prog)s '+version)
 
 	args = parser.parse_args()
@@ -84,11 +88,32 @@ def main():
 	else:
 		logging.info("Added all the variables we expected")
 
-	ecu.bind()
+	try:
+		if (args.transport == 'socket'):
+			transport = mbetransport.SocketTransport(args.interface, args.response_id, args.query_id)
+		elif (args.transport == 'canstack'):
+			transport = mbetransport.CanStackTransport(args.interface, args.response_id, args.query_id, args.bustype)
+		elif (args.transport == 'simulator'):
+			transport = mbetransport.SimulatorTransport(mbetransport.SimulatedECU(ecu.ecu_variables))
+		else:
+			transport = None
+	except OSError as e:
+		logging.error(f"Unable to open the {args.transport} transport on {args.interface}: {e}")
+		exit()
+
+	if (not ecu.bind(transport)):
+		logging.error("Unable to bind to the ECU")
+		exit()
+
+	if (args.output != None and not ecu.enable_logging(args.output)):
+		logging.error("Unable to log polled data")
+		exit()
 
 	results = dict()
 	if (ecu.process_all_pages(results) != False):
 		logging.debug(pprint.pformat(results))
 
+	ecu.stop_logging()
+
 if __name__ == '__main__':
 	main()
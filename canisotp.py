@@ -0,0 +1,189 @@
+# canisotp
+# Incremental ISOTP (ISO 15765-2) reassembly of raw CAN frames
+#
+# Feed frames one at a time, from a capture or a live candump pipe (see canpcap.py), and get back
+# each message as it completes. State is kept per CAN ID so interleaved requests and responses don't get mixed up.
+# Multi frame messages are written straight into a buffer of the length the first frame announces and handed
+# back as a memoryview of it, single frame messages are a memoryview of the frame itself, so nothing is copied
+# that doesn't have to be. Take bytes() of a message's data if it needs to outlive the next frame.
+#
+# Frame types:
+#   0 single frame:      [0L] data, L bytes
+#   1 first frame:       [1L LL] data, 12 bit length (or 0 followed by a 32 bit length)
+#   2 consecutive frame: [2S] data, S the sequence number counting 1..15, 0, 1...
+#   3 flow control:      [3F BS ST] flow status, block size and separation time from the receiver
+#
+
+import logging
+
+version = "0.1"
+
+single_frame = 0x0
+first_frame = 0x1
+consecutive_frame = 0x2
+flow_control = 0x3
+
+# A complete ISOTP message
+class Message():
+	__slots__ = ('can_id', 'timestamp', 'data', 'frames')
+
+	def __init__(self, can_id, timestamp, data, frames):
+		self.can_id = can_id
+		self.timestamp = timestamp # Of the frame that completed the message
+		self.data = data # A memoryview
+		self.frames = frames # How many CAN frames the message took
+
+	def __repr__(self):
+		return f"Message(can_id={self.can_id:#x}, timestamp={self.timestamp}, data={bytes(self.data).hex()}, frames={self.frames})"
+
+# A multi frame message we've had the first frame of
+class PendingMessage():
+	__slots__ = ('buffer', 'view', 'length', 'received', 'sequence', 'frames', 'timestamp')
+
+	def __init__(self, length, timestamp):
+		self.buffer = bytearray(length)
+		self.view = memoryview(self.buffer)
+		self.length = length
+		self.received = 0
+		self.sequence = 1
+		self.frames = 1
+		self.timestamp = timestamp # Of the last frame received
+
+	def append(self, data):
+		count = min(len(data), self.length - self.received)
+		self.view[self.received:self.received + count] = data[:count]
+		self.received = self.received + count
+
+class Reassembler():
+	# can_ids: only reassemble frames with these IDs, None for every ID
+	# timeout: drop a multi frame message if the gap between its frames is longer than this many seconds (needs timestamps)
+	def __init__(self, can_ids=None, max_length=4095, timeout=None):
+		self.can_ids = None if can_ids == None else frozenset(can_ids)
+		self.max_length = max_length
+		self.timeout = timeout
+		self.pending = dict()
+		self.flow_control = dict() # can_id -> (flow status, block size, separation time) of the last flow control frame
+		self.last_type = None # The frame type of the last frame fed, None if it was ignored
+		self.last_payload = None # The data carried by the last frame fed, after its PCI bytes
+		self.errors = 0
+
+	def error(self, can_id, message):
+		self.errors = self.errors + 1
+		logging.debug(f"ISOTP {can_id:#x}: {message}")
+
+	def reset(self):
+		self.pending.clear()
+		self.flow_control.clear()
+		self.last_type = None
+		self.last_payload = None
+
+	# Feed a CAN frame, returns a Message if it completed one otherwise None
+	def feed(self, can_id, frame, timestamp=None):
+		self.last_type = None
+		self.last_payload = None
+
+		if (self.can_ids != None and not can_id in self.can_ids):
+			return None
+
+		if (len(frame) == 0):
+			self.error(can_id, "empty frame")
+			return None
+
+		frame = memoryview(frame)
+		frame_type = frame[0] >> 4
+		self.last_type = frame_type
+
+		if (frame_type == single_frame):
+			length = frame[0] & 0x0f
+			start = 1
+			if (length == 0 and len(frame) > 8): # CAN FD escape, the length is in the next byte
+				length = frame[1]
+				start = 2
+			self.last_payload = frame[start:start + length]
+			if (length == 0 or start + length > len(frame)):
+				self.error(can_id, f"single frame with bad length {length}")
+				return None
+			if (can_id in self.pending):
+				self.error(can_id, "single frame while a multi frame message was in progress")
+				del self.pending[can_id]
+			return Message(can_id, timestamp, frame[start:start + length], 1)
+
+		if (frame_type == first_frame):
+			if (len(frame) < 2):
+				self.error(can_id, "short first frame")
+				return None
+			length = ((frame[0] & 0x0f) << 8) | frame[1]
+			start = 2
+			if (length == 0): # Escape, 32 bit length
+				if (len(frame) < 6):
+					self.error(can_id, "short first frame")
+					return None
+				length = int.from_bytes(frame[2:6], byteorder='big')
+				start = 6
+			self.last_payload = frame[start:]
+			if (length <= len(frame) - start or length > self.max_length):
+				self.error(can_id, f"first frame with bad length {length}")
+				return None
+			if (can_id in self.pending):
+				self.error(can_id, "first frame while a multi frame message was in progress")
+			message = PendingMessage(length, timestamp)
+			message.append(self.last_payload)
+			self.pending[can_id] = message
+			return None
+
+		if (frame_type == consecutive_frame):
+			self.last_payload = frame[1:]
+			message = self.pending.get(can_id)
+			if (message == None):
+				self.error(can_id, "consecutive frame without a first frame")
+				return None
+			if (self.timeout != None and timestamp != None and message.timestamp != None and timestamp - message.timestamp > self.timeout):
+				self.error(can_id, "timed out waiting for a consecutive frame")
+				del self.pending[can_id]
+				return None
+			if ((frame[0] & 0x0f) != message.sequence):
+				self.error(can_id, f"consecutive frame {frame[0] & 0x0f} out of sequence, expected {message.sequence}")
+				del self.pending[can_id]
+				return None
+			message.append(self.last_payload)
+			message.sequence = (message.sequence + 1) & 0x0f
+			message.frames = message.frames + 1
+			message.timestamp = timestamp
+			if (message.received < message.length):
+				return None
+			del self.pending[can_id]
+			return Message(can_id, timestamp, message.view, message.frames)
+
+		if (frame_type == flow_control):
+			if (len(frame) < 3):
+				self.error(can_id, "short flow control frame")
+				return None
+			self.flow_control[can_id] = (frame[0] & 0x0f, frame[1], frame[2])
+			return None
+
+		self.error(can_id, f"unknown frame type {frame_type}")
+		self.last_type = None
+		return None
+
+	# Feed a CAN frame and report it the way Wireshark's iso15765 dissector does
+	# Returns (frame type, fragment count, payload): the payload is the data in this frame, except on the frame that
+	# completes a multi frame message where it's the whole message and fragment count is the number of frames it took
+	# Frames that carry no data (flow control, or anything that was ignored) give (None, 0, None), frames that were
+	# rejected as malformed still report whatever data they carried
+	def feed_frame(self, can_id, frame, timestamp=None):
+		message = self.feed(can_id, frame, timestamp)
+
+		if (self.last_type == None or self.last_type == flow_control or self.last_payload == None):
+			return None, 0, None
+
+		if (message != None):
+			return self.last_type, (message.frames if message.frames > 1 else 0), message.data
+
+		return self.last_type, 0, self.last_payload
+
+	# Reassemble a stream of (timestamp, can_id, frame) tuples, yielding each Message as it completes
+	def messages(self, frames):
+		for timestamp, can_id, frame in frames:
+			message = self.feed(can_id, frame, timestamp)
+			if (message != None):
+				yield message
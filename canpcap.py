@@ -0,0 +1,274 @@
+# canpcap
+# Reads CAN frames out of pcap and pcapng captures without needing Wireshark
+#
+# The captures in captures/ were taken with tcpdump/Wireshark on a SocketCAN interface, so every packet is a
+# Linux cooked capture (SLL) header followed by a SocketCAN frame: CAN ID (host byte order, the Pi is little
+# endian), data length, 3 bytes of padding and 8 bytes of data. Captures using the SocketCAN link type have
+# the same frame without the SLL header and with the CAN ID in network byte order.
+#
+# Files are memory mapped and walked with struct.unpack_from, so even multi-hour captures are read at disk speed.
+# candump output (saved, or piped in live) can be read too.
+#
+
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+
+version = "0.1"
+
+# pcapng block types
+block_section_header = 0x0a0d0d0a
+block_interface_description = 0x00000001
+block_enhanced_packet = 0x00000006
+
+byte_order_magic = 0x1a2b3c4d
+
+# Classic pcap magic numbers (as read little endian)
+pcap_magic_microseconds = 0xa1b2c3d4
+pcap_magic_nanoseconds = 0xa1b23c4d
+pcap_header_length = 24
+pcap_record_length = 16
+
+# Link types
+linktype_linux_sll = 113
+linktype_can_socketcan = 227
+
+sll_header_length = 16
+
+# CAN ID flags
+can_eff_flag = 0x80000000 # Extended (29 bit) frame
+can_rtr_flag = 0x40000000
+can_err_flag = 0x20000000
+can_eff_mask = 0x1fffffff
+
+# Parse a pcapng interface description block's options to find its timestamp resolution (seconds per tick)
+def interface_resolution(block, endian):
+	offset = 16
+	resolution = 1e-6
+
+	while (offset + 4 <= len(block) - 4):
+		code, length = struct.unpack_from(endian + 'HH', block, offset)
+		if (code == 0):
+			break
+		if (code == 9 and length >= 1): # if_tsresol
+			value = block[offset + 4]
+			if (value & 0x80):
+				resolution = 2.0 ** -(value & 0x7f)
+			else:
+				resolution = 10.0 ** -value
+		offset = offset + 4 + ((length + 3) & ~3)
+
+	return resolution
+
+# Pull the CAN ID and data out of a packet, returns None if it isn't a CAN frame we understand
+def decode_packet(capture, packet, captured_length, linktype):
+	if (linktype == linktype_linux_sll):
+		if (captured_length < sll_header_length + 8):
+			return None
+		can_id, dlc = struct.unpack_from('<IB', capture, packet + sll_header_length)
+		data_start = packet + sll_header_length + 8
+	elif (linktype == linktype_can_socketcan):
+		if (captured_length < 8):
+			return None
+		can_id, dlc = struct.unpack_from('>IB', capture, packet)
+		data_start = packet + 8
+	else:
+		logging.debug(f"Skipping packet with link type {linktype}")
+		return None
+
+	dlc = min(dlc, 8, captured_length - (data_start - packet))
+	return can_id & can_eff_mask, capture[data_start:data_start + dlc]
+
+# The byte order and interfaces of a pcapng section, and the offset of its first packet
+# Used to start reading part way through a file, tcpdump and Wireshark describe every interface before the first packet
+def read_pcapng_preamble(capture):
+	offset = 0
+	endian = '<'
+	interfaces = list()
+
+	while (offset + 12 <= len(capture)):
+		block_type, block_length = struct.unpack_from(endian + 'II', capture, offset)
+
+		if (block_type == block_section_header):
+			(magic,) = struct.unpack_from('<I', capture, offset + 8)
+			endian = '<' if magic == byte_order_magic else '>'
+			(block_length,) = struct.unpack_from(endian + 'I', capture, offset + 4)
+			interfaces = list()
+		elif (block_type == block_interface_description):
+			(linktype,) = struct.unpack_from(endian + 'H', capture, offset + 8)
+			interfaces.append((linktype, interface_resolution(capture[offset:offset + block_length], endian)))
+		elif (block_type == block_enhanced_packet):
+			break
+
+		if (block_length < 12):
+			break
+
+		offset = offset + block_length
+
+	return endian, interfaces, offset
+
+# start and end are byte offsets, blocks starting before end are read, start must be on a block boundary (see split_capture)
+def read_pcapng_packets(capture, filename, start=None, end=None):
+	if (start == None):
+		offset = 0
+		endian = '<'
+		interfaces = list()
+	else:
+		endian, interfaces, offset = read_pcapng_preamble(capture)
+		offset = max(offset, start)
+
+	end = len(capture) if end == None else end
+
+	while (offset < end and offset + 12 <= len(capture)):
+		block_type, block_length = struct.unpack_from(endian + 'II', capture, offset)
+
+		if (block_type == block_section_header):
+			# The byte order magic tells us how to read the rest of this section
+			(magic,) = struct.unpack_from('<I', capture, offset + 8)
+			endian = '<' if magic == byte_order_magic else '>'
+			(block_length,) = struct.unpack_from(endian + 'I', capture, offset + 4)
+			interfaces = list()
+		elif (block_type == block_interface_description):
+			(linktype,) = struct.unpack_from(endian + 'H', capture, offset + 8)
+			interfaces.append((linktype, interface_resolution(capture[offset:offset + block_length], endian)))
+		elif (block_type == block_enhanced_packet):
+			interface, high, low, captured_length = struct.unpack_from(endian + 'IIII', capture, offset + 8)
+			linktype, resolution = interfaces[interface]
+			frame = decode_packet(capture, offset + 28, captured_length, linktype)
+			if (frame != None):
+				yield offset, ((high << 32) | low) * resolution, frame[0], frame[1]
+
+		if (block_length < 12):
+			logging.error(f"Corrupt pcapng block at offset {offset} in {filename}")
+			break
+
+		offset = offset + block_length
+
+def read_pcap_packets(capture, filename, start=None, end=None):
+	(magic,) = struct.unpack_from('<I', capture, 0)
+	if (magic in (pcap_magic_microseconds, pcap_magic_nanoseconds)):
+		endian = '<'
+	else:
+		endian = '>'
+		(magic,) = struct.unpack_from('>I', capture, 0)
+
+	resolution = 1e-9 if magic == pcap_magic_nanoseconds else 1e-6
+	(linktype,) = struct.unpack_from(endian + 'I', capture, 20)
+	linktype = linktype & 0x0fffffff # The top bits can hold the FCS length
+	record = endian + 'IIII'
+	offset = pcap_header_length if start == None else max(start, pcap_header_length)
+	end = len(capture) if end == None else end
+
+	while (offset < end and offset + pcap_record_length <= len(capture)):
+		seconds, fraction, captured_length, original_length = struct.unpack_from(record, capture, offset)
+		packet = offset + pcap_record_length
+
+		if (packet + captured_length > len(capture)):
+			logging.error(f"Truncated pcap record at offset {offset} in {filename}")
+			break
+
+		frame = decode_packet(capture, packet, captured_length, linktype)
+		if (frame != None):
+			yield offset, seconds + fraction * resolution, frame[0], frame[1]
+
+		offset = packet + captured_length
+
+# What sort of capture a file is: 'pcapng', 'pcap' or None
+def capture_format(filename):
+	with open(filename, 'rb') as f:
+		header = f.read(4)
+
+	if (len(header) < 4):
+		return None
+
+	(magic,) = struct.unpack('<I', header)
+	if (magic == block_section_header):
+		return 'pcapng'
+	if (magic in (pcap_magic_microseconds, pcap_magic_nanoseconds) or struct.unpack('>I', header)[0] in (pcap_magic_microseconds, pcap_magic_nanoseconds)):
+		return 'pcap'
+	return None
+
+# Yield (offset, timestamp, can_id, data) for every CAN frame in a pcap or pcapng file
+# offset is where the frame's block (or record) starts in the file, can_id has the flag bits removed, data is bytes
+# start and end limit reading to the blocks that start from start up to (not including) end, start must be a block boundary
+def read_packets(filename, start=None, end=None):
+	file_format = capture_format(filename)
+	if (file_format == None):
+		logging.error(f"{filename} isn't a pcap or pcapng file")
+		return
+
+	with open(filename, 'rb') as f:
+		capture = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+	try:
+		if (file_format == 'pcapng'):
+			yield from read_pcapng_packets(capture, filename, start, end)
+		else:
+			yield from read_pcap_packets(capture, filename, start, end)
+	finally:
+		capture.close()
+
+# Yield (timestamp, can_id, data) for every CAN frame in a pcap or pcapng file
+def read_frames(filename, start=None, end=None):
+	for offset, timestamp, can_id, data in read_packets(filename, start, end):
+		yield timestamp, can_id, data
+
+# Split a capture into about count byte ranges on block boundaries, so they can be read in parallel
+# is_boundary(can_id, data) picks which frames a range may start at, e.g. the start of a new request so that no
+# ISOTP message or request/response pair straddles two ranges
+# Returns a list of (start, end, frames before start)
+def split_capture(filename, count, is_boundary=None):
+	size = os.path.getsize(filename)
+	targets = [size * i // count for i in range(1, count)]
+	starts = [(None, 0)]
+	frames = 0
+
+	for offset, timestamp, can_id, data in read_packets(filename):
+		if (len(targets) > 0 and offset >= targets[0] and (is_boundary == None or is_boundary(can_id, data))):
+			starts.append((offset, frames))
+			while (len(targets) > 0 and targets[0] <= offset):
+				targets.pop(0)
+		frames = frames + 1
+
+	ranges = list()
+	for i, (start, skipped) in enumerate(starts):
+		end = starts[i + 1][0] if i + 1 < len(starts) else None
+		ranges.append((start, end, skipped))
+
+	return ranges
+
+# candump -L / candump -l log lines: (1566411226.184749) can0 0CBE1101#0100000000F87C7D
+candump_log_pattern = re.compile(r'^\s*\((\d+\.\d+)\)\s+\S+\s+([0-9A-Fa-f]+)#([0-9A-Fa-f]*)')
+# Plain candump output, optionally with -t a timestamps: (1566411226.184749)  can0  0CBE1101   [8]  10 0A 01 00 00 00 00 F8
+candump_pattern = re.compile(r'^\s*(?:\((\d+\.\d+)\)\s+)?\S+\s+([0-9A-Fa-f]+)\s+\[(\d+)\]\s*((?:[0-9A-Fa-f]{2}\s*)*)')
+
+# Parse candump output into (timestamp, can_id, frame) tuples, timestamp is None if candump wasn't showing them
+# lines can be an open file or sys.stdin, so it works on a live `candump -L can0 | ...` pipe
+# Lines that aren't CAN frames (remote frames, errors, CAN FD ## frames) are skipped
+def read_candump(lines):
+	for line in lines:
+		match = candump_log_pattern.match(line)
+		if (match != None):
+			yield float(match.group(1)), int(match.group(2), 16), bytes.fromhex(match.group(3))
+			continue
+
+		match = candump_pattern.match(line)
+		if (match != None):
+			timestamp = float(match.group(1)) if match.group(1) != None else None
+			yield timestamp, int(match.group(2), 16), bytes.fromhex(match.group(4))
+			continue
+
+		logging.debug(f"Skipping candump line {line.rstrip()}")
+
+# Yield (timestamp, can_id, frame) from a pcap, pcapng or candump file, or candump output on stdin if filename is -
+def read_capture(filename):
+	if (filename == '-'):
+		yield from read_candump(sys.stdin)
+	elif (capture_format(filename) != None):
+		yield from read_frames(filename)
+	else:
+		with open(filename, 'r', errors='replace') as f:
+			yield from read_candump(f)
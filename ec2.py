@@ -0,0 +1,470 @@
+# ec2
+# Parses an MBE EC2 ECU file (as used by Easimap) into Parameters and Scales
+#
+# The file is read once, a line at a time. Each line is checked against a few precompiled patterns to find the
+# [<SECTION_NAME>] ... [end <SECTION_NAME>] pairs and the lines inside the sections we want are handed straight to
+# that section's handler:
+# HISTORY
+# PROPERTIES
+# PARAMETER PROTOTYPES
+# NUMERIC SCALES
+# STRING SCALES
+# PARAMETER DEFINITIONS
+# COLLECTIONS
+# ALARMS
+# SPECIAL FUNCTIONS
+# MAPPING VECTORS
+# MAPPING CONTROLS
+# SETUP PROTOTYPES
+# SETUP DEFINITIONS
+# MAP PROGRAMS
+# VARIANTS
+# SPECIAL INTERFACE PROTOTYPES
+# MATRICES
+#
+# Parsed files are cached on disk keyed by a hash of their contents, so loading the same EC2 file again is just
+# reading back the cache:
+#
+#   ec2file = ec2.parse('ec2/9A4be52a.ec2.utf8')
+#   ec2file.parameters['RT_ENGINESPEED'].page
+#   variables = ec2file.variables() # The same dictionary ec2parse.py writes to the JSON variables file
+#
+# The cache is pickled, and unpickling runs code, so the cache directory must be private to the user. It's created
+# with mode 0700 and a cache directory or file that isn't owned by us, or that others can write to, is ignored.
+#
+
+import logging
+import hashlib
+import pickle
+import io
+import os
+import re
+import mbedb
+
+version = "0.1"
+
+# Where parsed files are cached, MBE_CACHE overrides it
+cache_directory = os.environ.get('MBE_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'mbe'))
+
+section_start_pattern = re.compile(r'\[([\w\s\(\)_]*)\]')
+section_end_pattern = re.compile(r'\[end\s([^\]]*)\]') # \w\s\(\)_
+entry_name_pattern = re.compile(r'\[([^\]]*)\]') # \w\s\)\(
+parameter_field_pattern = re.compile(r'([\w\s]*) = ([^\=]*)')
+scale_field_pattern = re.compile(r'([\w\s]*) = ([\w\s\-\.]*)')
+
+# Get all the variable names, page, address and byte width
+# [RT_ENGINESPEED]
+# Number of Dimensions = 0
+# Page = F8
+# Address = 237C
+# Bytes per Cell = 2
+# 0 = SCALE_ENGINESPEED
+# Precision = 0
+
+parameter_field_mapping = dict(
+	{"Number of Dimensions":"dimensions",
+	 "Page":"page",
+	 "Address":"address",
+	 "Bytes per Cell":"bytes",
+	 "0":"scale0",
+	 "1":"scale1",
+	 "2":"scale2",
+	 "Precision":"precision",
+	 "Signed":"signed",
+	 "Variant Title":"variant_title",
+	 "Sector":"sector",
+	 "Main":"main",
+	 "Trim":"trim",
+	 "Data Class":"class",
+	 "Parameter 1":"parameter1",
+	 "Parameter 2":"parameter2",
+	 "Index 1":"index1",
+	 "Index 2":"index2",
+	 "Dummy Variable":"dummy",
+	 "Proteaus":"proteaus",
+	 "Proteaus Colour":"proteaus_colour"
+	})
+
+# Get all the scaling information for each var
+# [SCALE_ENGINESPEED]
+# Units = RPM
+# Scale Minimum = 0.000000
+# Scale Maximum = 65535.000000
+# Display Minimum = 0.000000
+# Display Maximum = 12000.000000
+# Display Interval = 1000.000000
+
+scale_field_mapping = dict(
+	{"Scale Minimum":"scale_minimum",
+	 "Scale Maximum":"scale_maximum",
+	 "Scale Interval":"scale_interval",
+	 "Scale Points":"scale_points",
+	 "Display Minimum":"display_minimum",
+	 "Display Maximum":"display_maximum",
+	 "Display Interval":"display_interval",
+	 "Display Points":"display_points",
+	 "Precision":"precision",
+	 "Units":"units"
+	})
+
+# A numeric scale, fields holds the text of every x = y line keyed by scale_field_mapping
+class Scale():
+	def __init__(self, name, fields=None):
+		self.name = name
+		self.fields = fields if fields != None else dict()
+
+	@property
+	def units(self):
+		return self.fields.get('units', "")
+
+	@property
+	def minimum(self):
+		return float(self.fields['scale_minimum'])
+
+	@property
+	def maximum(self):
+		return float(self.fields['scale_maximum'])
+
+	def __repr__(self):
+		return f"Scale({self.name!r}, {self.fields.get('scale_minimum')}..{self.fields.get('scale_maximum')} {self.units!r})"
+
+# A parameter definition, fields holds the text of every x = y line keyed by parameter_field_mapping
+# The descriptions and disabled flag come from its line in PARAMETER PROTOTYPES
+class Parameter():
+	def __init__(self, name, fields=None):
+		self.name = name
+		self.fields = fields if fields != None else {'name':name}
+		self.short_desc = ""
+		self.long_desc = ""
+		self.disabled = ""
+
+	@property
+	def page(self):
+		return int(self.fields['page'], 16)
+
+	@property
+	def address(self):
+		return int(self.fields['address'], 16)
+
+	@property
+	def bytes(self):
+		return int(self.fields['bytes'])
+
+	@property
+	def dimensions(self):
+		return int(self.fields.get('dimensions', 0))
+
+	@property
+	def scale(self):
+		return self.fields.get('scale0', "")
+
+	# Only SCALE (numeric) parameters are output at the moment, not STRING
+	@property
+	def is_numeric(self):
+		return self.scale[:5] == 'SCALE'
+
+	@property
+	def is_disabled(self):
+		return str(self.disabled).lower() == "disabled"
+
+	def __repr__(self):
+		return f"Parameter({self.name!r}, page={self.fields.get('page')!r}, address={self.fields.get('address')!r}, bytes={self.fields.get('bytes')!r})"
+
+# One axis of a map, points sites long
+# index is the name of the curve (Number of Dimensions = 2) that holds the value at each site, e.g. the engine speed
+# of each speed site, without one the axis is just the site numbers from its scale
+class Axis():
+	def __init__(self, scale, index=None, parameter=None):
+		self.scale = scale
+		self.index = index
+		self.parameter = parameter # The RT_ variable saying which site the ECU's using
+		self.points = int(scale.fields.get('scale_points', 0))
+
+	# The site numbers along the axis
+	def sites(self):
+		minimum = float(self.scale.fields.get('scale_minimum', 0))
+		interval = float(self.scale.fields.get('scale_interval', 1))
+		return [minimum + (site * interval) for site in range(self.points)]
+
+	def __repr__(self):
+		return f"Axis({self.scale.name!r}, points={self.points}, index={self.index!r})"
+
+# A calibration value, curve or table in the ECU's memory
+# Number of Dimensions counts the value itself: 1 is a single value, 2 a curve along Index 1 and 3 a table along
+# Index 1 and Index 2. Cells are bytes wide little endian and stored in order with the last axis changing fastest
+class Map():
+	def __init__(self, parameter, scale, axes):
+		self.name = parameter.name
+		self.page = parameter.page
+		self.address = parameter.address
+		self.bytes = parameter.bytes
+		self.scale = scale
+		self.axes = axes
+		self.short_desc = parameter.short_desc
+		self.units = scale.units
+
+	# Number of sites along each axis, () for a single value
+	@property
+	def shape(self):
+		return tuple(axis.points for axis in self.axes)
+
+	@property
+	def cells(self):
+		cells = 1
+		for axis in self.axes:
+			cells = cells * axis.points
+		return cells
+
+	# Bytes of ECU memory the map takes up
+	@property
+	def length(self):
+		return self.cells * self.bytes
+
+	def __repr__(self):
+		return f"Map({self.name!r}, page={self.page:#04x}, address={self.address:#06x}, bytes={self.bytes}, shape={self.shape})"
+
+# A parsed EC2 file
+class EC2():
+	def __init__(self, filename, sections, parameters, scales, digest=None):
+		self.version = version
+		self.filename = filename
+		self.sections = sections # name -> {'start': line, 'end': line}
+		self.parameters = parameters # name -> Parameter, in file order
+		self.scales = scales # name -> Scale, in file order
+		self.digest = digest
+
+	# The variable definition ec2parse.py outputs for a parameter (all strings, like the JSON variables file)
+	def variable(self, parameter, include_disabled=False):
+		scale = self.scales[parameter.scale]
+		variable = {
+			'name':parameter.name,
+			'page':"0x"+parameter.fields['page'].lower(),
+			'address':"0x"+parameter.fields['address'].lower(),
+			'bytes':parameter.fields['bytes']
+		}
+		if (include_disabled):
+			variable['disabled'] = parameter.disabled
+		variable.update({
+			'scale_minimum':scale.fields['scale_minimum'],
+			'scale_maximum':scale.fields['scale_maximum'],
+			'display_minimum':scale.fields['display_minimum'],
+			'display_maximum':scale.fields['display_maximum'],
+			'display_interval':scale.fields['display_interval'],
+			'units':scale.fields['units'],
+			'short_desc':parameter.short_desc,
+			'long_desc':parameter.long_desc
+		})
+		return variable
+
+	# Every numeric variable as a dictionary of name -> definition, disabled ones are left out unless asked for
+	def variables(self, include_disabled=False):
+		variables = dict()
+		for parameter in self.parameters.values():
+			if (parameter.is_numeric and (include_disabled or not parameter.is_disabled)):
+				variables[parameter.name] = self.variable(parameter, include_disabled)
+		return variables
+
+	# The variables as compact mbedb.Variables for mbe.py, their descriptions are read back from here
+	def mbe_variables(self):
+		variables = dict()
+		for name, variable in self.variables().items():
+			variables[name] = mbedb.Variable(self, name, variable)
+		return variables
+
+	# Every numeric value, curve and table (Number of Dimensions 1, 2 and 3) as a dictionary of name -> Map
+	# Maps whose scales or axes aren't defined in the file are left out
+	def maps(self):
+		maps = dict()
+		for parameter in self.parameters.values():
+			m = self.map(parameter.name)
+			if (m != None):
+				maps[m.name] = m
+		return maps
+
+	def map(self, name):
+		parameter = self.parameters.get(name)
+		if (parameter == None or not parameter.is_numeric or parameter.is_disabled):
+			return None
+
+		fields = parameter.fields
+		dimensions = int(fields.get('dimensions', 0))
+		if (dimensions < 1 or dimensions > 3 or not 'page' in fields or not 'address' in fields or not 'bytes' in fields):
+			return None
+
+		scale = self.scales.get(parameter.scale)
+		if (scale == None):
+			return None
+
+		axes = list()
+		for i in range(1, dimensions):
+			axis_scale = self.scales.get(fields.get(f"scale{i}", ""))
+			if (axis_scale == None):
+				logging.debug(f"{name} has no scale for axis {i}")
+				return None
+			axis = Axis(axis_scale, fields.get(f"index{i}"), fields.get(f"parameter{i}"))
+			if (axis.points < 1):
+				logging.debug(f"{name} has no sites on axis {i}")
+				return None
+			axes.append(axis)
+
+		return Map(parameter, scale, axes)
+
+	# mbedb.Variable source interface, ref is the parameter name
+	def read_record(self, ref):
+		return self.variable(self.parameters[ref])
+
+	def read_field(self, ref, field):
+		return self.read_record(ref).get(field, "")
+
+	def __repr__(self):
+		return f"EC2({self.filename!r}, {len(self.parameters)} parameters, {len(self.scales)} scales)"
+
+# Streams an EC2 file through the section handlers
+class Parser():
+	def __init__(self):
+		self.sections = dict()
+		self.parameters = dict()
+		self.scales = dict()
+		self.prototypes = list()
+		self.parameter = None
+		self.scale = None
+		self.handlers = {
+			'PARAMETER DEFINITIONS':self.parameter_definition,
+			'NUMERIC SCALES':self.numeric_scale,
+			'PARAMETER PROTOTYPES':self.parameter_prototype
+		}
+
+	def parse(self, lines):
+		section = None
+		handler = None
+		for i, line in enumerate(lines):
+			if ('[' in line):
+				m = section_end_pattern.search(line)
+				if (m):
+					self.sections.setdefault(m[1], dict())['end'] = i
+					if (m[1] == section):
+						section = None
+						handler = None
+					continue
+				if (section == None):
+					m = section_start_pattern.search(line)
+					if (m):
+						section = m[1]
+						self.sections.setdefault(section, dict())['start'] = i
+						handler = self.handlers.get(section)
+						continue
+			if (handler != None):
+				handler(line)
+
+		# The prototypes come before the definitions they describe, so they're added once everything's been read
+		for name, short_desc, long_desc, disabled in self.prototypes:
+			parameter = self.parameters[name]
+			parameter.short_desc = short_desc
+			parameter.long_desc = long_desc
+			parameter.disabled = disabled
+
+	# PARAMETER DEFINITIONS, a [name] followed by its x = y lines
+	def parameter_definition(self, line):
+		m = entry_name_pattern.match(line)
+		if (m):
+			self.parameter = self.parameters[m[1]] = Parameter(m[1])
+		else:
+			m = parameter_field_pattern.match(line)
+			if (m):
+				self.parameter.fields[parameter_field_mapping[m[1]]] = m[2].strip('\n')
+
+	# NUMERIC SCALES, a [name] followed by its x = y lines
+	def numeric_scale(self, line):
+		m = entry_name_pattern.match(line)
+		if (m):
+			self.scale = self.scales[m[1]] = Scale(m[1])
+		else:
+			m = scale_field_pattern.match(line)
+			if (m):
+				self.scale.fields[scale_field_mapping[m[1]]] = m[2].strip('\n')
+
+	# PARAMETER PROTOTYPES, name, short description, ?, long description, disabled
+	def parameter_prototype(self, line):
+		comma_sep = line.split(',')
+		if (len(comma_sep) >= 4):
+			name = comma_sep[0].strip('\n')
+			short_desc = comma_sep[1].strip('\n')
+			long_desc = comma_sep[3].strip('\n')
+			disabled = comma_sep[4].strip(' \n') if len(comma_sep) > 4 else ""
+			self.prototypes.append((name, short_desc, long_desc, disabled))
+		elif (len(comma_sep) > 1):
+			raise ValueError(f"Unexpected parameter prototype {comma_sep}")
+
+# Parse the text of an EC2 file, data is its bytes
+def parse_data(data, filename=None, digest=None):
+	parser = Parser()
+	parser.parse(io.TextIOWrapper(io.BytesIO(data), encoding='utf-8', errors='replace'))
+	return EC2(filename, parser.sections, parser.parameters, parser.scales, digest)
+
+def cache_filename(digest, directory=None):
+	return os.path.join(directory if directory != None else cache_directory, digest + '.ec2.pickle')
+
+# Is a cache directory or file safe to trust, owned by us and not writable by anyone else
+# There's no ownership to check on platforms without getuid
+def is_private(stat):
+	if (not hasattr(os, 'getuid')):
+		return True
+	return stat.st_uid == os.getuid() and (stat.st_mode & 0o022) == 0
+
+# Make the cache directory (private to the user) if it isn't there, returns False if it can't be trusted
+def private_cache_directory(directory):
+	os.makedirs(directory, mode=0o700, exist_ok=True)
+	if (not is_private(os.stat(directory))):
+		logging.warning(f"Not using the EC2 cache in {directory}, it must be owned by the user and not writable by anyone else")
+		return False
+	return True
+
+# Parse an EC2 file, or load it from the cache if this exact file has been parsed before
+def parse(filename, cache=True, directory=None):
+	with open(filename, 'rb') as f:
+		data = f.read()
+	digest = hashlib.sha256(data).hexdigest()
+
+	if (cache):
+		try:
+			cache = private_cache_directory(directory if directory != None else cache_directory)
+		except OSError as e:
+			logging.warning(f"Unable to use the EC2 cache: {e}")
+			cache = False
+
+	if (cache):
+		try:
+			with open(cache_filename(digest, directory), 'rb') as f:
+				if (not is_private(os.fstat(f.fileno()))):
+					raise pickle.UnpicklingError(f"{f.name} isn't private to the user")
+				parsed = pickle.load(f)
+			if (isinstance(parsed, EC2) and parsed.version == version and parsed.digest == digest):
+				parsed.filename = filename
+				return parsed
+		except pickle.UnpicklingError as e:
+			logging.warning(f"Ignoring cached EC2 file: {e}")
+		except (OSError, EOFError, AttributeError, ImportError):
+			pass
+
+	parsed = parse_data(data, filename, digest)
+
+	if (cache):
+		try:
+			temp_filename = cache_filename(digest, directory) + f".{os.getpid()}"
+			with open(os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+				pickle.dump(parsed, f, protocol=pickle.HIGHEST_PROTOCOL)
+			os.replace(temp_filename, cache_filename(digest, directory))
+		except OSError as e:
+			logging.warning(f"Unable to cache {filename}: {e}")
+
+	return parsed
+
+# Check whether a file looks like an EC2 file (they start with # comments or a [section]) rather than JSON or a
+# compiled database
+def is_ec2(filename):
+	try:
+		with open(filename, 'rb') as f:
+			start = f.read(64).lstrip()
+	except IOError:
+		return False
+	return start[:1] in (b'#', b'[')
@@ -18,35 +18,76 @@
 test_mode = True # Turns off calls to isotp layer and uses simple test data
 
 if (test_mode):
-	response_data = {'0xf8' : b'\x81\xe7\x49\x21\x53\x00\x00\x3e\x97', '0xf9' : b'\x81\x78\x1e\xdc\x1e'}
+	response_data = {0xf8 : b'\x81\xe7\x49\x21\x53\x00\x00\x3e\x97', 0xf9 : b'\x81\x78\x1e\xdc\x1e'}
 
 import logging
-import json
-import re
-import binascii
-import itertools
+import struct
+import collections
+import concurrent.futures
+import asyncio
+import time
 import pprint
-import isotp
+import mbedb
+import ec2
+import mbetransport
+import mbehistory
+import mbelog
 
 version = "0.1"
 
+# struct format characters for each variable width, the ECU returns its data little endian
+# There's no native 24bit type so 3 byte variables are unpacked as raw bytes and converted afterwards
+struct_formats = {1:'B', 2:'H', 3:'3s', 4:'I'}
+
+# Largest message ISOTP can carry on classic CAN (12 bit length)
+isotp_max_length = 4095
+
+# Number of CAN frames needed to move an ISOTP message of a given length
+# A single frame carries up to 7 bytes, longer messages are a first frame (6 bytes), consecutive frames (7 bytes each)
+# and a flow control frame back from the receiver
+def isotp_frame_count(length):
+	if (length <= 7):
+		return 1
+	consecutive_frames = ((length - 6) + 6) // 7 # ceil((length - 6) / 7)
+	return 1 + consecutive_frames + 1
+
 class mbe():
 	# Initialize class using a filename to load json ec2 definitions and tx(query) and rx(response) CAN id's
 	def __init__(self):
 		self.ecu_variables = dict()
 		self.ecu_mappings = dict()
-		self.ecu_vars_to_follow = dict()
+		self.ecu_vars_to_follow = mbedb.PageIndex()
+		self.ecu_follow_frequencies = dict()
+		self.ecu_page_requests = dict()
+		self.ecu_subset_requests = dict()
+		self.ecu_next_due = dict()
+		self.ecu_sample_stats = dict()
+		self.ecu_maps = dict()
 		self.interface = "can0"
+		self.pipeline_depth = 0
+		self.max_request_length = isotp_max_length
+		self.max_response_length = isotp_max_length
+		self.decoder = None
+		self.history = None
+		self.logger = None
+		self.socket = None
 		self.rxid = 0x0cbe0111
 		self.txid = 0x0cbe1101
 		logging.info(f"Test mode is {test_mode}")
 
 	def set_options(self, filename, txid=0x0cbe1101, rxid=0x0cbe0111, interface="can0"):
-		self.ecu_variables = self.load_mbe_variables_from_json(filename)
+		self.ecu_maps = dict()
+		self.ecu_variables = self.load_mbe_variables(filename)
 		if (self.ecu_variables == False):
 			return False
-		self.ecu_mappings = self.create_page_reverse_mapping(self.ecu_variables)
-		self.ecu_vars_to_follow = dict()
+		# The reverse mapping needs every variable so it's only built if something asks for it
+		self.ecu_mappings = dict()
+		self.ecu_vars_to_follow = mbedb.PageIndex()
+		self.ecu_follow_frequencies = dict()
+		self.ecu_page_requests = dict()
+		self.ecu_subset_requests = dict()
+		self.ecu_next_due = dict()
+		self.ecu_sample_stats = dict()
 		self.interface = interface
 		# ID's must be ints
 		if (isinstance(rxid, int)):
@@ -61,18 +102,54 @@ class mbe():
 			return False
 		return True
 
+	# Load the ec2 definitions from either a compiled database (see mbedb.py), the EC2 file itself (see ec2.py) or json
+	def load_mbe_variables(self, filename):
+		if (mbedb.is_database(filename)):
+			return self.load_mbe_variables_from_database(filename)
+		if (ec2.is_ec2(filename)):
+			return self.load_mbe_variables_from_ec2(filename)
+		return self.load_mbe_variables_from_json(filename)
+
+	# Parse the EC2 file directly, repeat loads of the same file come from ec2.py's cache
+	def load_mbe_variables_from_ec2(self, filename):
+		try:
+			ec2file = ec2.parse(filename)
+		except (IOError, ValueError) as e:
+			logging.error(f"Unable to load EC2 file {filename}: {e}")
+			return False
+
+		# The maps only come from the EC2 file, the JSON and compiled database just have the variables
+		self.ecu_maps = ec2file.maps()
+		return ec2file.mbe_variables()
+
+	# Load the map definitions from an EC2 file when the variables came from somewhere else
+	def load_maps(self, filename):
+		try:
+			self.ecu_maps = ec2.parse(filename).maps()
+		except (IOError, ValueError) as e:
+			logging.error(f"Unable to load EC2 file {filename}: {e}")
+			return False
+		return True
+
+	# Open a compiled database, variables are only read from it as they're looked up
+	def load_mbe_variables_from_database(self, filename):
+		try:
+			return mbedb.VariableDatabase(filename)
+		except (IOError, ValueError) as e:
+			logging.error(f"Unable to load variables database {filename}: {e}")
+			return False
+
 	# Load the json ec2 definitions
+	# Each variable is held as a compact mbedb.Variable, descriptions are read back from the file when they're needed
 	def load_mbe_variables_from_json(self, filename):
+		variables = dict()
+
 		try:
-			f = open(filename, "r")
+			variables = mbedb.load_json(filename)
 		except IOError:
 			logging.error(f"Unable to open file {filename}")
 			return False
-		variables = dict()
-
-		try:
-			variables = json.load(f)
-		except ValueError:  # includes simplejson.decoder.JSONDecodeError
+		except ValueError:  # includes json.decoder.JSONDecodeError
 			logging.error('Decoding JSON has failed')
 			return False
 
@@ -82,44 +159,46 @@ class mbe():
 	def log_variables(self, count=None):
 		i = 0
 		for var in self.ecu_variables.values():
-			logging.info(pprint.pformat(var))
+			logging.info(pprint.pformat(var.as_dict()))
 			i = i + 1
 			if((count != None) and (i > count)):
 				break
 
-	# Create a reverse mapping dictionary of the pages/LSBs we've loaded, the length of each var (bytes) and names
+	# Create a reverse mapping of the pages/LSBs we've loaded, the length of each var (bytes) and names
 	def create_page_reverse_mapping(self, variables):
-		mapping = dict()
-		for i in variables:
-			LSBstring = variables[i]['address'][-2:]
-			page = variables[i]['page']
-			# Check if we already have a page entry
-			if (not page in mapping):
-				mapping[page] = dict()
-			mapping[page][LSBstring] = {'name':variables[i]['name'], 'bytes':variables[i]['bytes']}
-
-		return mapping
+		return mbedb.PageIndex.from_variables(variables)
 
 	# Debug routine to make sure we've got some good page definitions from our ec2 variables file
 	def log_pages(self, count=None):
+		if (len(self.ecu_mappings) == 0):
+			self.ecu_mappings = self.create_page_reverse_mapping(self.ecu_variables)
 		i = 0
-		for var in self.ecu_mappings.values():
-			logging.info(pprint.pformat(var))
+		for page in self.ecu_mappings:
+			logging.info(f"Page {page:#04x}: " + pprint.pformat(self.ecu_mappings.entries(page)))
 			i = i + 1
 			if((count != None) and (i > count)):
 				break
 
-	def bind(self):
-		if (not test_mode):
-			self.socket = isotp.socket()
-			self.socket.set_opts(0x480, frame_txtime=0) # 0x400 NOFLOW_MODE, 0x80 FORCESTMIN
-			self.socket.bind("can0", isotp.Address(isotp.AddressingMode.Normal_29bits, rxid=self.rxid, txid=self.txid))
+	# Open the transport to the ECU, by default the kernel ISOTP socket on self.interface
+	# transport: use this instead, anything with send() and recv() will do (see mbetransport.py)
+	# e.g. mbetransport.SimulatorTransport or mbereplay.ReplayTransport to play back a capture
+	# In test mode with no transport the canned response_data is used
+	def bind(self, transport=None):
+		if (transport != None):
+			self.socket = transport
+		elif (not test_mode):
+			try:
+				self.socket = mbetransport.SocketTransport(self.interface, self.rxid, self.txid)
+			except (OSError, ImportError) as e:
+				logging.error(f"Unable to open ISOTP socket on {self.interface}: {e}")
+				return False
 
 		return True
 
 
-	# Add a variable to interogate on the ECU (frequency of requests not currently supported)
-	# We do this by creating a dict of pages, then put all the vars we want to follow as an ordered (lsb) list in each pages
+	# Add a variable to interogate on the ECU
+	# frequency is the rate in Hz we'd like the variable polled at, None means poll it on every call to process_all_pages
+	# We do this by creating an index of pages, then put all the vars we want to follow as an ordered (lsb) list in each pages
 	# ... that list will then be the vars that are constructed into a compound request to the ECU
 	# Not sure if an ordered list is important but Easimap sends queries to the ECU in an ordered list so we'll do the same
 	def add_variable_to_follow(self, name, frequency=None):
@@ -138,77 +217,269 @@ class mbe():
 			logging.warning(f"Unable to add variable to follow because we don't have an ec2 definition for {name}")
 			return False
 
-		# Set up some commonly accessed params
-		page = self.ecu_variables[name]['page']
-		lsb = self.ecu_variables[name]['address'][-2:]
-		bytes = self.ecu_variables[name]['bytes']
+		if (frequency != None and (not isinstance(frequency, (int, float)) or frequency <= 0)):
+			logging.error(f"Unable to add {name} with a frequency of {frequency}, it must be a positive number of Hz")
+			return False
 
-		# Test to see if this page already exists and if not add an empty list
-		if(not page in self.ecu_vars_to_follow):
-			self.ecu_vars_to_follow[page] = list()
+		page, lsb, bytes = mbedb.variable_location(self.ecu_variables[name])
 
-		# Find where to insert in the list
-		insert_position = 0
+		# The index keeps each page in LSB order and won't add a second variable at the same LSB
+		if (not self.ecu_vars_to_follow.add(page, lsb, bytes, name)):
+			logging.warning(f"Unable to add {name} as duplicate")
+			return False
 
-		for i, val in enumerate(self.ecu_vars_to_follow[page]):
-			# Make sure this isn't a duplicate
+		if (frequency != None):
+			self.ecu_follow_frequencies[name] = frequency
 
-			if (val['lsb'] == lsb):
-				logging.warning(f"Unable to add {name} as duplicate")
-				return False
+		# The set of variables for this page has changed so any cached request or decode plan is now stale
+		self.invalidate_page(page)
 
-			insert_position = i + 1
-			logging.debug(f"Checking:{i} {int(lsb,16)} ({lsb}) {int(val['lsb'],16)} ({val['lsb']})")
+		logging.debug(f"Added {name} at {page:#04x}:{lsb:02x}")
 
-			if (int(val['lsb'],16) > int(lsb,16)):
-				insert_position = i
-				#logging.info(f"Adding {lsb} at position {insert_position}, before {self.ecu_vars_to_follow[page][i]['lsb']}")
-				break
+		return True
+
+	# Stop interogating a variable on the ECU
+	def remove_variable_to_follow(self, name):
+		if (not name in self.ecu_variables):
+			logging.warning(f"Unable to remove variable because we don't have an ec2 definition for {name}")
+			return False
 
-		# Now insert this entry into the page's list
-		self.ecu_vars_to_follow[page].insert(insert_position, {
-				'name':name,
-				'bytes': bytes,
-				'lsb':lsb,
-				'frequency':frequency
-			})
+		page, lsb, bytes = mbedb.variable_location(self.ecu_variables[name])
+		followed = self.ecu_vars_to_follow.find(page, lsb)
+		if (followed == None or followed[1] != name):
+			logging.warning(f"Unable to remove {name} as it isn't being followed")
+			return False
+
+		# The index drops empty pages so we won't end up sending requests for no data
+		self.ecu_vars_to_follow.remove(page, lsb)
 
-		logging.debug(f"Added {lsb} at position {insert_position}")
+		self.invalidate_page(page)
+		self.ecu_follow_frequencies.pop(name, None)
+		self.ecu_next_due.pop(name, None)
+		self.ecu_sample_stats.pop(name, None)
 
 		return True
 
-	# Add a list of variables to interogate on the ECU (frequency of requests not currently supported)
-	def add_variable_list_to_follow(self, name_list, frequency=None):
-		count = 0
+	# Throw away anything we've precomputed for a page, called whenever its followed variables change
+	def invalidate_page(self, page):
+		self.ecu_page_requests.pop(page, None)
+		for key in [key for key in self.ecu_subset_requests if key[0] == page]:
+			del self.ecu_subset_requests[key]
 
-		for i in name_list:
-			ret = self.add_variable_to_follow(i, frequency)
-			if (ret):
-				count = count + 1
+	# Add a list of variables to interogate on the ECU, all at the same frequency
+	def add_variable_list_to_follow(self, name_list, frequency=None):
+		report = self.follow(name_list, frequency)
 
 		logging.debug(pprint.pformat(self.ecu_vars_to_follow))
 
-		return count
+		return len(report['added'])
+
+	# Bulk version of add_variable_to_follow for large follow sets
+	# Every name is validated first, then the new variables are grouped by page, sorted and merged into the
+	# follow index once per page rather than being inserted one at a time
+	# Returns {'added': [names], 'rejected': {name: reason}}
+	def follow(self, names, frequency=None):
+		report = {'added': list(), 'rejected': dict()}
+
+		if (frequency != None and (not isinstance(frequency, (int, float)) or frequency <= 0)):
+			logging.error(f"Unable to follow variables with a frequency of {frequency}, it must be a positive number of Hz")
+			for name in names:
+				report['rejected'][str(name)] = "invalid frequency"
+			return report
+
+		new_entries = dict()
+		seen = set()
+
+		for name in names:
+			if (not isinstance(name, str)):
+				report['rejected'][str(name)] = "not a string"
+				continue
+
+			# Repeats of a name are dropped, it's reported once as either added or rejected
+			if (name in seen):
+				continue
+			seen.add(name)
+
+			if (not name in self.ecu_variables):
+				report['rejected'][name] = "no ec2 definition"
+				continue
+
+			page, lsb, bytes = mbedb.variable_location(self.ecu_variables[name])
+			page_entries = new_entries.setdefault(page, dict())
+
+			# Something at this LSB is either already followed or earlier in this list
+			if (self.ecu_vars_to_follow.find(page, lsb) != None or lsb in page_entries):
+				report['rejected'][name] = "duplicate address"
+				continue
+
+			page_entries[lsb] = (lsb, bytes, name)
+
+		for page, page_entries in new_entries.items():
+			if (len(page_entries) == 0):
+				continue
+
+			self.ecu_vars_to_follow.merge(page, sorted(page_entries.values()))
+			self.invalidate_page(page)
+
+			for lsb, bytes, name in page_entries.values():
+				report['added'].append(name)
+				if (frequency != None):
+					self.ecu_follow_frequencies[name] = frequency
+
+		if (len(report['rejected']) > 0):
+			logging.warning(f"Unable to follow {len(report['rejected'])} variables: " + pprint.pformat(report['rejected']))
 
-	def create_data_request(self, page_name, page):
-		request_string = ""
+		return report
 
-		for item in page:
-			logging.debug(pprint.pformat(item, width=120))
-			lsb_int = int(item['lsb'],16)
+	# Build the request frame for a page: 0x01 0x00000000 <page> followed by the LSB of every byte we want back
+	# entries is a list of (lsb, bytes, name) as held in the follow index
+	def create_data_request(self, page, entries):
+		request = bytearray(b'\x01\x00\x00\x00\x00')
+		request.extend(page.to_bytes(max(1, (page.bit_length() + 7) // 8), byteorder='big'))
 
-			for i in range(0,int(item['bytes'])):
-				request_string = request_string + '{:^2s}'.format(f'{lsb_int+i:02x}')
+		for lsb, width, name in entries:
+			request.extend(range(lsb, lsb + width))
 
-		request_string = "0100000000" + page_name[2:] + request_string
-		logging.debug(f"Request string:{request_string}")
+		logging.debug(f"Request:{request.hex()}")
 
-		return binascii.unhexlify(request_string)
+		return bytes(request)
 
-	def process_data_response(self, response, vars_to_follow):
+	# Limit the size of the requests we send and the responses we ask for
+	# Pages with more followed bytes than fit are split across several requests
+	def set_request_limits(self, max_request_length=isotp_max_length, max_response_length=isotp_max_length):
+		# We always need room for the request header and the widest (4 byte) variable
+		if (not isinstance(max_request_length, int) or max_request_length < 10 or max_request_length > isotp_max_length):
+			logging.error(f"Maximum request length must be an integer between 10 and {isotp_max_length}")
+			return False
+
+		if (not isinstance(max_response_length, int) or max_response_length < 5 or max_response_length > isotp_max_length):
+			logging.error(f"Maximum response length must be an integer between 5 and {isotp_max_length}")
+			return False
+
+		# Pages above 0xff have a longer header, so check every variable we're following still fits on its own
+		for page in self.ecu_vars_to_follow:
+			header_length = len(self.create_data_request(page, []))
+			widest = max(entry[1] for entry in self.ecu_vars_to_follow.entries(page))
+			if (header_length + widest > max_request_length or 1 + widest > max_response_length):
+				logging.error(f"A request for page {page:#x} needs at least {header_length + widest} bytes, and its response {1 + widest}")
+				return False
+
+		self.max_request_length = max_request_length
+		self.max_response_length = max_response_length
+
+		# Everything we've already planned might now be the wrong size
+		self.ecu_page_requests = dict()
+		self.ecu_subset_requests = dict()
+
+		return True
+
+	# Split a page's (lsb, bytes, name) entries into chunks that each fit in one request and response
+	# Variables stay in LSB order, and of all the ways of splitting them that respect the limits we pick the
+	# one that needs the fewest CAN frames (then the fewest requests) using a shortest path over the entries
+	# Returns False if a variable is too wide to fit in a request for this page on its own
+	def split_entries(self, page, entries):
+		header_length = len(self.create_data_request(page, []))
+		count = len(entries)
+
+		# best[i] is (frames, requests, start of last chunk) for the cheapest way to send the first i entries
+		best = [None] * (count + 1)
+		best[0] = (0, 0, None)
+
+		for end in range(1, count + 1):
+			width = 0
+			for start in range(end - 1, -1, -1):
+				width = width + entries[start][1]
+				if (header_length + width > self.max_request_length or 1 + width > self.max_response_length):
+					break
+				if (best[start] == None):
+					continue
+				frames = best[start][0] + isotp_frame_count(header_length + width) + isotp_frame_count(1 + width)
+				cost = (frames, best[start][1] + 1, start)
+				if (best[end] == None or cost[:2] < best[end][:2]):
+					best[end] = cost
+
+		if (best[count] == None):
+			logging.error(f"Unable to fit every variable in page {page:#x} into requests of {self.max_request_length} bytes and responses of {self.max_response_length}")
+			return False
+
+		chunks = list()
+		end = count
+		while (end > 0):
+			start = best[end][2]
+			chunks.insert(0, entries[start:end])
+			end = start
+
+		return chunks
+
+	# Build the list of (page, request, decode plan) needed to poll a set of entries from a page
+	# If they can't be split to fit the request limits the list is empty and the page isn't polled
+	def create_page_requests(self, page, entries):
+		requests = list()
+
+		chunks = self.split_entries(page, entries)
+		if (chunks == False):
+			return requests
+
+		for chunk in chunks:
+			requests.append((page, self.create_data_request(page, chunk), self.create_decode_plan(chunk)))
+
+		if (len(requests) > 1):
+			logging.debug(f"Page {page:#04x} has been split into {len(requests)} requests")
+
+		return requests
+
+	# Return the requests for every variable followed in a page, only rebuilding them if the followed set has changed
+	def get_page_requests(self, page):
+		requests = self.ecu_page_requests.get(page)
+		if (requests == None):
+			requests = self.create_page_requests(page, self.ecu_vars_to_follow.entries(page))
+			self.ecu_page_requests[page] = requests
+		return requests
+
+	# Compile a page's list of followed variables, (lsb, bytes, name) entries, into a decode plan
+	# The plan holds a single struct that unpacks every variable in a response in one call, plus the
+	# scale factor and offset for each variable so we don't have to re-parse the ec2 strings on every poll
+	def create_decode_plan(self, entries):
+		format_string = "<"
+		names = list()
+		factors = list()
+		offsets = list()
+		descriptions = list()
+		wide = list()
+
+		for i, (lsb, bytes, name) in enumerate(entries):
+			variable = self.ecu_variables[name]
+
+			if (not bytes in struct_formats):
+				logging.error(f"Unable to decode {name} with a width of {bytes} bytes")
+				return False
+
+			format_string = format_string + struct_formats[bytes]
+			if (bytes == 3):
+				wide.append(i)
+
+			scale = float(variable['scale_maximum']) - float(variable['scale_minimum'])
+			dividend = float((2 ** (bytes * 8)) - 1)
+			names.append(name)
+			factors.append(scale / dividend)
+			offsets.append(float(variable['scale_minimum']))
+			descriptions.append({'short_desc':variable['short_desc'], 'units':variable['units']})
+
+		unpacker = struct.Struct(format_string)
+
+		return {
+			'struct': unpacker,
+			'length': unpacker.size + 1, # Includes the 0x81 response byte
+			'names': names,
+			'factors': factors,
+			'offsets': offsets,
+			'descriptions': descriptions,
+			'wide': wide
+		}
+
+	def process_data_response(self, response, plan):
 		#81aaaa1600
 		logging.debug(response)
-		logging.debug(hex(int.from_bytes(response, byteorder='big', signed=False)))
 		data_length = len(response)
 
 		if (data_length < 2):
@@ -219,69 +490,434 @@ class mbe():
 			logging.debug(f"Response data needs to have a 1st byte of 0x81, we got {hex(response[0])}")
 			return None
 
-		i = 1
-		results = dict()
+		# A response of any other length is stale or was meant for another request, decoding it would give plausible
+		# but wrong values
+		if (data_length != plan['length']):
+			logging.error(f"Discarding a response of {data_length} bytes, the request was for {plan['length']} bytes")
+			return False
 
-		for var in vars_to_follow:
-			#logging.debug(pprint.pformat(var))
-			name = var['name']
-			bytes = int(var['bytes'])
-			value = bytearray()
+		raw = plan['struct'].unpack_from(response, 1)
 
-			for j in range(0,bytes):
-				#logging.debug(hex(response[i+j]))
-				value.insert(0,response[i+j])
+		if (plan['wide']):
+			raw = list(raw)
+			for i in plan['wide']:
+				raw[i] = int.from_bytes(raw[i], byteorder='little', signed=False)
 
-			#logging.debug(value)
-			variable = self.ecu_variables[name]
-			scale = float(variable['scale_maximum']) - float(variable['scale_minimum'])
-			dividend = (2 ** (bytes * 8)) - 1
-			offset = float(variable['scale_minimum'])
-			response_int = int.from_bytes(value, byteorder='big', signed=False)
-			response_scaled = ((float(response_int * scale)) / float(dividend)) + offset
-			#logging.debug(f"{name}={response_scaled:.5} {variable['units']} ({variable['short_desc']} ) [{binascii.hexlify(value)}, Scale:{scale}, Div:{dividend}, Offset:{offset:.3}]")
-			results[name] = {'name': name, 'value':response_scaled, 'short_desc':variable['short_desc'], 'units':variable['units']}
-			i = i + bytes
-
-			if (i > data_length):
-				logging.error(f"Ran off the end of our response array, counter got to {i} but array length is {data_length}")
-				return False
+		results = dict()
+
+		for name, value, factor, offset, description in zip(plan['names'], raw, plan['factors'], plan['offsets'], plan['descriptions']):
+			results[name] = {'name': name, 'value':(value * factor) + offset, 'short_desc':description['short_desc'], 'units':description['units']}
 
 		return results
 
+	# Keep a ring buffer of the last capacity samples of every followed variable in self.history
+	# See mbehistory.py, needs numpy
+	def enable_history(self, capacity=mbehistory.default_capacity):
+		if (mbehistory.numpy == None):
+			logging.error("History needs numpy, which isn't installed")
+			return False
+
+		if (not isinstance(capacity, int) or capacity < 1):
+			logging.error(f"History capacity must be a positive integer")
+			return False
+
+		self.history = mbehistory.History(capacity)
+		return True
+
+	# Log every polled sample to a columnar log file, see mbelog.py
+	def enable_logging(self, filename, chunk_size=mbelog.default_chunk_size):
+		self.stop_logging()
+
+		try:
+			self.logger = mbelog.LogWriter(filename, chunk_size)
+		except IOError:
+			logging.error(f"Unable to open log file {filename}")
+			return False
+
+		return True
+
+	# Finish the log file, writing out anything still buffered and the index
+	def stop_logging(self):
+		if (self.logger != None):
+			self.logger.close()
+			self.logger = None
+		return True
+
+	# Configure pipelined polling in process_all_pages
+	# depth = 0 polls each page serially (send, wait for response, decode, next page)
+	# depth = 1 sends the next page's request as soon as a response arrives and decodes on a worker thread while the bus is busy
+	# depth > 1 also keeps up to depth requests in flight, only use this if the ECU is known to queue requests
+	def set_pipeline_depth(self, depth):
+		if (not isinstance(depth, int) or depth < 0):
+			logging.error(f"Pipeline depth must be a positive integer or zero")
+			return False
+
+		self.pipeline_depth = depth
+
+		if (depth > 0 and self.decoder == None):
+			# A single worker keeps updates to the results dictionary in the order the responses arrived
+			self.decoder = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="mbe-decode")
+
+		return True
+
+	# Send a data request to the ECU
+	def send_request(self, page, command):
+		logging.debug(pprint.pformat(command))
+
+		if (test_mode and self.socket == None):
+			return True
+
+		try:
+			self.socket.send(command)
+		except:
+			logging.error("Unable to send to socket")
+			return False
+
+		return True
+
+	# Wait for the ECU to respond to a data request for a page
+	def receive_response(self, page):
+		if (test_mode and self.socket == None):
+			# Some dummy data for RT_ENGINESPEED
+			return response_data[page]
+
+		try:
+			return self.socket.recv()
+		except:
+			logging.error("Unable to receive from socket")
+			return None
+
+	# Decode a response and merge it into the results dictionary
+	# If there's already an entry for this variable in the results array then just update the value
+	# Otherwise add a new entry to the results dictionary
+	def update_results(self, results, response, plan):
+		page_results = self.process_data_response(response, plan)
+		if (not page_results):
+			return False
+
+		now = time.monotonic()
+
+		for name, result in page_results.items():
+			if( name in results):
+				results[name]['value'] = result['value']
+			else:
+				results[name] = {'name': name, 'value':result['value'], 'short_desc':result['short_desc'], 'units':result['units']}
+
+		if (self.history != None):
+			for name, result in page_results.items():
+				self.history.record(name, now, result['value'])
+
+		if (self.logger != None):
+			wall_clock = time.time()
+			for name, result in page_results.items():
+				self.logger.record(name, wall_clock, result['value'])
+
+		# Keep a count and time window of samples for each variable so we can report the rates we're achieving
+		for name in plan['names']:
+			stats = self.ecu_sample_stats.get(name)
+			if (stats == None):
+				self.ecu_sample_stats[name] = [1, now, now]
+			else:
+				stats[0] = stats[0] + 1
+				stats[2] = now
+
+		return True
+
+	# Decide whether a followed variable is due to be polled, and if it is, when it'll next be due
+	# We step the due time on by exactly one period so the average rate matches what was asked for,
+	# but if we've fallen more than a period behind we don't try to catch up with a burst of requests
+	def is_due(self, name, now):
+		frequency = self.ecu_follow_frequencies.get(name)
+		if (frequency == None):
+			return True
+
+		next_due = self.ecu_next_due.get(name, now)
+		if (now < next_due):
+			return False
+
+		period = 1.0 / frequency
+		next_due = next_due + period
+		if (next_due <= now):
+			next_due = now + period
+		self.ecu_next_due[name] = next_due
+
+		return True
+
+	# Build the list of (page, request, decode plan) to send this time round, only including variables that are due
+	# Pages where everything is due use the cached full page requests, otherwise requests for a subset of a page
+	# are cached by the names they contain, rate groups repeat so there are only ever a few of these per page
+	def get_poll_requests(self, now=None):
+		if (now == None):
+			now = time.monotonic()
+
+		requests = list()
+
+		for page in self.ecu_vars_to_follow:
+			# Without any rate groups every variable is always due
+			if (len(self.ecu_follow_frequencies) == 0):
+				requests.extend(self.get_page_requests(page))
+				continue
+
+			due = [entry for entry in self.ecu_vars_to_follow.entries(page) if self.is_due(entry[2], now)]
+
+			if (len(due) == self.ecu_vars_to_follow.count(page)):
+				requests.extend(self.get_page_requests(page))
+			elif (len(due) > 0):
+				key = (page, tuple(entry[2] for entry in due))
+				subset = self.ecu_subset_requests.get(key)
+				if (subset == None):
+					subset = self.create_page_requests(page, due)
+					self.ecu_subset_requests[key] = subset
+				requests.extend(subset)
+
+		return requests
+
+	# Report the requested and achieved polling rate (Hz) for every followed variable
+	# achieved is None until we've had at least two samples of a variable
+	def get_rate_report(self):
+		report = dict()
+
+		for page in self.ecu_vars_to_follow:
+			for lsb, bytes, name in self.ecu_vars_to_follow.entries(page):
+				stats = self.ecu_sample_stats.get(name, [0, 0.0, 0.0])
+				achieved = None
+				if (stats[2] > stats[1]):
+					achieved = (stats[0] - 1) / (stats[2] - stats[1])
+				report[name] = {'requested': self.ecu_follow_frequencies.get(name), 'achieved': achieved, 'samples': stats[0]}
+
+		return report
+
 	def process_all_pages(self, results):
 		if (not isinstance(results, dict )):
 			return False
 
-		for page in self.ecu_vars_to_follow:
-			command = self.create_data_request(page, self.ecu_vars_to_follow[page])
-			logging.info(pprint.pformat(command))
+		if (self.pipeline_depth > 0):
+			return self.process_all_pages_pipelined(results)
+
+		for page, command, plan in self.get_poll_requests():
+			if (not self.send_request(page, command)):
+				break
+
+			response = self.receive_response(page)
+			if(response == None):
+				break
+
+			if (not self.update_results(results, response, plan)):
+				break
+
+		return results
 
-			if (test_mode):
-				# Some dummy data for RT_ENGINESPEED
-				response = response_data[page]
+	# Poll every followed page keeping up to pipeline_depth requests in flight
+	# Responses come back in the order the requests were sent so we just match them up first in first out
+	def process_all_pages_pipelined(self, results):
+		requests = self.get_poll_requests()
+		in_flight = collections.deque()
+		decodes = list()
+		next_request = 0
+		sending = True
+
+		while (True):
+			# Top up the pipeline
+			while (sending and next_request < len(requests) and len(in_flight) < self.pipeline_depth):
+				page, command, plan = requests[next_request]
+				if (not self.send_request(page, command)):
+					sending = False
+					break
+				in_flight.append((page, plan))
+				next_request = next_request + 1
+
+			if (len(in_flight) == 0):
+				break
+
+			page, plan = in_flight.popleft()
+			response = self.receive_response(page)
+
+			if (response == None):
+				# Stop sending but keep receiving so anything still in flight doesn't turn up against next cycle's requests
+				sending = False
+				continue
+
+			# The wrong length means responses and requests have got out of step, so don't queue any more
+			if (len(response) != plan['length']):
+				logging.error(f"Discarding a response of {len(response)} bytes for page {page:#04x}, the request was for {plan['length']} bytes")
+				sending = False
+				continue
+
+			decodes.append(self.decoder.submit(self.update_results, results, response, plan))
+
+		for decode in decodes:
+			if (not decode.result()):
+				logging.debug("Unable to decode a pipelined response")
+
+		return results
+
+
+# asyncio flavour of the mbe class
+# The ISOTP socket is switched to non-blocking and registered with the running event loop, so polling the ECU
+# can share a process with other asyncio tasks without tying up a thread in socket.recv()
+class AsyncMbe(mbe):
+	def __init__(self, response_timeout=1.0):
+		super().__init__()
+		self.response_timeout = response_timeout
+		self.results = dict()
+		self.flush_pending = False
+
+	def bind(self, transport=None):
+		if (not super().bind(transport)):
+			return False
+		if (hasattr(self.socket, 'settimeout')):
+			self.socket.settimeout(0.0)
+		return True
+
+	# Wait until the socket is readable (or writable) without blocking the event loop
+	async def wait_for_socket(self, writable=False):
+		loop = asyncio.get_running_loop()
+		fd = self.socket.fileno()
+		ready = loop.create_future()
+
+		def on_ready():
+			if (not ready.done()):
+				ready.set_result(True)
+
+		if (writable):
+			loop.add_writer(fd, on_ready)
+		else:
+			loop.add_reader(fd, on_ready)
+
+		try:
+			await ready
+		finally:
+			if (writable):
+				loop.remove_writer(fd)
 			else:
+				loop.remove_reader(fd)
+
+	# Throw away any responses waiting on the socket
+	# After a timeout the late response (and any others that were in flight) would otherwise be read back against
+	# the next requests and decoded with their plans
+	def flush_responses(self):
+		discarded = 0
+
+		while (True):
+			try:
+				response = self.socket.recv()
+			except BlockingIOError:
+				break
+			except:
+				logging.error("Unable to receive from socket")
+				break
+
+			if (response == None):
+				break
+			discarded = discarded + 1
+
+		if (discarded > 0):
+			logging.warning(f"Discarded {discarded} stale responses")
+
+		self.flush_pending = False
+		return discarded
+
+	async def send_request_async(self, page, command):
+		logging.debug(pprint.pformat(command))
+
+		if (test_mode and self.socket == None):
+			return True
+
+		if (self.flush_pending):
+			self.flush_responses()
+
+		while (True):
+			try:
 				self.socket.send(command)
+				return True
+			except BlockingIOError:
+				await self.wait_for_socket(writable=True)
+			except:
+				logging.error("Unable to send to socket")
+				return False
+
+	async def receive_response_async(self, page):
+		if (test_mode and self.socket == None):
+			# Some dummy data for RT_ENGINESPEED
+			return response_data[page]
 
+		async def receive():
+			while (True):
 				try:
-					response = self.socket.recv()
-				except:
-					logging.error("Unable to receive from socket")
+					return self.socket.recv()
+				except BlockingIOError:
+					await self.wait_for_socket()
 
-			if(response == None):
+		try:
+			return await asyncio.wait_for(receive(), self.response_timeout)
+		except asyncio.TimeoutError:
+			logging.error(f"Timed out waiting for a response for page {page:#04x}")
+			self.flush_pending = True
+		except:
+			logging.error("Unable to receive from socket")
+
+		return None
+
+	# Poll every followed page once, keeping up to pipeline_depth requests in flight (at least one)
+	# Decoding happens on the event loop while the next request is on the bus
+	async def poll_once(self, results=None):
+		if (results == None):
+			results = self.results
+
+		if (not isinstance(results, dict )):
+			return False
+
+		requests = self.get_poll_requests()
+		in_flight = collections.deque()
+		next_request = 0
+		sending = True
+
+		while (True):
+			while (sending and next_request < len(requests) and len(in_flight) < max(1, self.pipeline_depth)):
+				page, command, plan = requests[next_request]
+				if (not await self.send_request_async(page, command)):
+					sending = False
+					break
+				in_flight.append((page, plan))
+				next_request = next_request + 1
+
+			if (len(in_flight) == 0):
 				break
 
-			page_results = self.process_data_response(response, self.ecu_vars_to_follow[page])
-			if (not page_results):
+			page, plan = in_flight.popleft()
+			response = await self.receive_response_async(page)
+
+			# We can't tell which request anything still to come is for, so give up on this poll and leave
+			# whatever turns up to be flushed before the next request goes out
+			if (response == None):
 				break
 
-			# If there's already an entry for this variable in the results array then just update the value
-			# Otherwise add a new entry to the results dictionary
-			for name, result in page_results.items():
-				if( name in results):
-					results[name]['value'] = result['value']
+			# Get the next request on the bus before we spend time decoding this one
+			if (sending and next_request < len(requests) and len(in_flight) < max(1, self.pipeline_depth)):
+				next_page, command, next_plan = requests[next_request]
+				if (await self.send_request_async(next_page, command)):
+					in_flight.append((next_page, next_plan))
+					next_request = next_request + 1
 				else:
-					results[name] = {'name': name, 'value':result['value'], 'short_desc':result['short_desc'], 'units':result['units']}
+					sending = False
+
+			if (not self.update_results(results, response, plan)):
+				logging.debug(f"Unable to decode response for page {page:#04x}")
+
+		return results
+
+	# Async iterator of result snapshots, polling the ECU every period seconds (or as fast as possible if period is 0)
+	# Each snapshot is a copy so consumers can hold on to it while polling carries on
+	async def snapshots(self, period=0):
+		loop = asyncio.get_running_loop()
+
+		while (True):
+			started = loop.time()
+			results = await self.poll_once()
+			if (results == False):
+				return
 
+			yield {name: dict(result) for name, result in results.items()}
 
-		return results
\ No newline at end of file
+			delay = period - (loop.time() - started)
+			await asyncio.sleep(max(0, delay))
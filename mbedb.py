@@ -0,0 +1,425 @@
+# mbedb
+# Compiled, memory mappable form of the MBE variables database produced by ec2parse.py
+# and compact in-memory records for variables loaded from it or from the JSON variables file
+#
+# The JSON variables file has to be parsed in full at every start, even though a poller only ever
+# follows a handful of variables. This format is a fixed size record per variable, sorted by name,
+# followed by a table of UTF-8 strings. The reader maps the file and only materialises the
+# variables that are actually looked up.
+#
+# Layout (all little endian):
+#   header:  magic (8 bytes), record count, record size, offset of records, offset of order table, offset of string table
+#   records: for every field in record_fields, a (string offset, string length) pair
+#   order:   a record index per variable, in the order they were in the source file
+#   strings: the UTF-8 text of every field, records point into this
+#
+
+import logging
+import array
+import bisect
+import json
+import json.decoder
+import mmap
+import struct
+import collections.abc
+
+version = "0.1"
+
+magic = b'MBEDB\x00\x00\x01'
+
+# Every variable in the JSON file has these fields (all strings), they're stored in this order in each record
+record_fields = (
+	'name',
+	'page',
+	'address',
+	'bytes',
+	'scale_minimum',
+	'scale_maximum',
+	'display_minimum',
+	'display_maximum',
+	'display_interval',
+	'units',
+	'short_desc',
+	'long_desc'
+)
+
+# Fields every loaded variable keeps in memory, these are all the polling code needs
+# The descriptive text and display ranges are read back from the source file if anything asks for them
+resident_fields = ('name', 'page', 'address', 'bytes', 'scale_minimum', 'scale_maximum', 'units')
+resident_field_set = frozenset(resident_fields)
+record_field_set = frozenset(record_fields)
+
+header_struct = struct.Struct('<8sIIIII')
+order_struct = struct.Struct('<I')
+record_struct = struct.Struct('<' + ('IH' * len(record_fields)))
+
+# Write a dictionary of variables (as loaded from the JSON file, or built by ec2parse.py) to a compiled database
+def write_database(variables, filename):
+	strings = bytearray()
+	string_offsets = dict()
+	records = list()
+
+	# Identical strings (units, scale values etc) are only stored once
+	def add_string(text):
+		encoded = str(text).encode('utf-8')
+		if (not encoded in string_offsets):
+			string_offsets[encoded] = len(strings)
+			strings.extend(encoded)
+		return string_offsets[encoded], len(encoded)
+
+	# Records are sorted by the encoded name so the reader can binary search them
+	names = sorted(variables, key=lambda name: name.encode('utf-8'))
+	for name in names:
+		variable = variables[name]
+		fields = list()
+		for field in record_fields:
+			fields.extend(add_string(variable.get(field, "")))
+		records.append(record_struct.pack(*fields))
+
+	# But iterating the database should give the same order as the source file
+	positions = {name: i for i, name in enumerate(names)}
+	order = b''.join(order_struct.pack(positions[name]) for name in variables)
+
+	records_offset = header_struct.size
+	order_offset = records_offset + (len(records) * record_struct.size)
+	strings_offset = order_offset + len(order)
+
+	with open(filename, 'wb') as f:
+		f.write(header_struct.pack(magic, len(records), record_struct.size, records_offset, order_offset, strings_offset))
+		for record in records:
+			f.write(record)
+		f.write(order)
+		f.write(strings)
+
+	return len(records)
+
+# A loaded variable
+# Behaves like the dictionaries in the JSON file (variable['page'] etc) but only holds the resident fields,
+# source is whatever it was loaded from and ref is where in that source its full definition lives
+class Variable():
+	__slots__ = resident_fields + ('source', 'ref')
+
+	def __init__(self, source, ref, fields):
+		self.source = source
+		self.ref = ref
+		for field in resident_fields:
+			setattr(self, field, fields.get(field, ""))
+
+	def __getitem__(self, field):
+		if (field in resident_field_set):
+			return getattr(self, field)
+		if (field in record_field_set):
+			return self.source.read_field(self.ref, field)
+		raise KeyError(field)
+
+	def get(self, field, default=None):
+		try:
+			return self[field]
+		except KeyError:
+			return default
+
+	def __contains__(self, field):
+		return field in record_field_set
+
+	def keys(self):
+		return record_fields
+
+	# Everything about the variable as a plain dictionary, this reads the source file
+	def as_dict(self):
+		variable = self.source.read_record(self.ref)
+		for field in resident_fields:
+			variable[field] = getattr(self, field)
+		return variable
+
+	def __repr__(self):
+		return f"Variable({self.name!r}, page={self.page!r}, address={self.address!r}, bytes={self.bytes!r})"
+
+# The numeric location of a variable: (page, lsb, bytes)
+# Requests to the ECU only carry the least significant byte of each address within a page
+def variable_location(variable):
+	return int(variable['page'], 16), int(variable['address'], 16) & 0xff, int(variable['bytes'])
+
+# Integer keyed index of variables by page and LSB address
+# Each page holds sorted arrays of LSBs and widths with a parallel list of names, so lookups and
+# insertion points are a binary search rather than string slicing and linear scans
+class PageIndex():
+	def __init__(self):
+		self.pages = dict()
+
+	# Build an index of every variable in a dictionary of variables
+	# Some variables share an LSB within a page, as with a dictionary the last one wins
+	@classmethod
+	def from_variables(cls, variables):
+		index = cls()
+		for name in variables:
+			page, lsb, bytes = variable_location(variables[name])
+			index.add(page, lsb, bytes, name, replace=True)
+		return index
+
+	# Add a variable, returns False if the page already has something at this LSB (unless replace is set)
+	def add(self, page, lsb, bytes, name, replace=False):
+		entries = self.pages.get(page)
+		if (entries == None):
+			entries = (array.array('B'), array.array('B'), list())
+			self.pages[page] = entries
+
+		lsbs, widths, names = entries
+		i = bisect.bisect_left(lsbs, lsb)
+
+		if (i < len(lsbs) and lsbs[i] == lsb):
+			if (not replace):
+				return False
+			widths[i] = bytes
+			names[i] = name
+			return True
+
+		lsbs.insert(i, lsb)
+		widths.insert(i, bytes)
+		names.insert(i, name)
+		return True
+
+	# Merge a sorted list of (lsb, bytes, name) into a page in one pass, none of the LSBs can already be in the page
+	def merge(self, page, entries):
+		if (not page in self.pages):
+			self.pages[page] = (array.array('B'), array.array('B'), list())
+
+		merged = sorted(self.entries(page) + list(entries))
+		lsbs, widths, names = self.pages[page]
+		lsbs[:] = array.array('B', [entry[0] for entry in merged])
+		widths[:] = array.array('B', [entry[1] for entry in merged])
+		names[:] = [entry[2] for entry in merged]
+
+	# Remove whatever is at an LSB in a page, empty pages are dropped
+	def remove(self, page, lsb):
+		entries = self.pages.get(page)
+		if (entries == None):
+			return False
+
+		lsbs, widths, names = entries
+		i = bisect.bisect_left(lsbs, lsb)
+		if (i >= len(lsbs) or lsbs[i] != lsb):
+			return False
+
+		del lsbs[i]
+		del widths[i]
+		del names[i]
+
+		if (len(lsbs) == 0):
+			del self.pages[page]
+
+		return True
+
+	# Return (bytes, name) for the variable at an LSB in a page, or None
+	def find(self, page, lsb):
+		entries = self.pages.get(page)
+		if (entries == None):
+			return None
+
+		lsbs, widths, names = entries
+		i = bisect.bisect_left(lsbs, lsb)
+		if (i < len(lsbs) and lsbs[i] == lsb):
+			return widths[i], names[i]
+
+		return None
+
+	# Return a list of (lsb, bytes, name) for every variable in a page with start <= lsb < end
+	def range(self, page, start=0, end=0x100):
+		entries = self.pages.get(page)
+		if (entries == None):
+			return list()
+
+		lsbs, widths, names = entries
+		first = bisect.bisect_left(lsbs, start)
+		last = bisect.bisect_left(lsbs, end)
+		return list(zip(lsbs[first:last], widths[first:last], names[first:last]))
+
+	# Return a list of (lsb, bytes, name) for every variable in a page, in LSB order
+	def entries(self, page):
+		lsbs, widths, names = self.pages[page]
+		return list(zip(lsbs, widths, names))
+
+	def count(self, page):
+		entries = self.pages.get(page)
+		if (entries == None):
+			return 0
+		return len(entries[0])
+
+	def __contains__(self, page):
+		return page in self.pages
+
+	def __iter__(self):
+		return iter(self.pages)
+
+	def __len__(self):
+		return len(self.pages)
+
+	def __repr__(self):
+		return repr({hex(page): self.entries(page) for page in self.pages})
+
+# Load a JSON variables file (as written by ec2parse.py) into a dictionary of Variables
+# The whole file has to be parsed once, but we remember the byte offset of each variable's definition
+# so its descriptive fields can be re-read later without keeping them all in memory
+def load_json(filename):
+	with open(filename, 'rb') as f:
+		data = f.read()
+
+	# latin-1 maps every byte to one character so string positions are file offsets
+	text = data.decode('latin-1')
+	source = JsonSource(filename)
+	decoder = json.JSONDecoder()
+	whitespace = json.decoder.WHITESPACE
+	variables = dict()
+
+	pos = whitespace.match(text, 0).end()
+	if (text[pos:pos + 1] != '{'):
+		raise ValueError(f"{filename} doesn't contain a JSON object")
+	pos = whitespace.match(text, pos + 1).end()
+
+	while (text[pos:pos + 1] != '}'):
+		if (text[pos:pos + 1] != '"'):
+			raise ValueError(f"Expecting a variable name at offset {pos} in {filename}")
+		name, pos = json.decoder.scanstring(text, pos + 1)
+		pos = whitespace.match(text, pos).end()
+		if (text[pos:pos + 1] != ':'):
+			raise ValueError(f"Expecting ':' at offset {pos} in {filename}")
+		start = whitespace.match(text, pos + 1).end()
+		fields, pos = decoder.raw_decode(text, start)
+
+		if (not name.isascii()):
+			name = name.encode('latin-1').decode('utf-8')
+		for field in resident_fields:
+			value = fields.get(field, "")
+			if (isinstance(value, str) and not value.isascii()):
+				fields[field] = value.encode('latin-1').decode('utf-8')
+
+		variables[name] = Variable(source, (start, pos - start), fields)
+
+		pos = whitespace.match(text, pos).end()
+		if (text[pos:pos + 1] == ','):
+			pos = whitespace.match(text, pos + 1).end()
+		elif (text[pos:pos + 1] != '}'):
+			raise ValueError(f"Expecting ',' or '}}' at offset {pos} in {filename}")
+
+	return variables
+
+# Reads individual variable definitions back out of a JSON variables file, ref is (offset, length)
+class JsonSource():
+	def __init__(self, filename):
+		self.filename = filename
+
+	def read_record(self, ref):
+		offset, length = ref
+		with open(self.filename, 'rb') as f:
+			f.seek(offset)
+			return json.loads(f.read(length).decode('utf-8'))
+
+	def read_field(self, ref, field):
+		return self.read_record(ref).get(field, "")
+
+# Check whether a file is a compiled database
+def is_database(filename):
+	try:
+		with open(filename, 'rb') as f:
+			return f.read(len(magic)) == magic
+	except IOError:
+		return False
+
+# Read only view of a compiled database that behaves like the dictionary of variables loaded from JSON
+# Variables are decoded from the mapped file the first time they're looked up and then kept as Variables,
+# their descriptive fields are read from the mapped string table when they're asked for
+class VariableDatabase(collections.abc.Mapping):
+	def __init__(self, filename):
+		self.filename = filename
+		self.file = open(filename, 'rb')
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		file_magic, self.count, self.record_size, self.records_offset, self.order_offset, self.strings_offset = header_struct.unpack_from(self.map, 0)
+		if (file_magic != magic or self.record_size != record_struct.size):
+			self.close()
+			raise ValueError(f"{filename} is not a compiled MBE variables database we can read")
+
+		self.variables = dict()
+
+	def close(self):
+		self.map.close()
+		self.file.close()
+
+	def read_string(self, offset, length):
+		start = self.strings_offset + offset
+		return self.map[start:start + length].decode('utf-8')
+
+	# Return the (offset, length) pairs for a record
+	def read_offsets(self, index):
+		return record_struct.unpack_from(self.map, self.records_offset + (index * self.record_size))
+
+	def read_name(self, index):
+		offset, length = record_struct.unpack_from(self.map, self.records_offset + (index * self.record_size))[:2]
+		start = self.strings_offset + offset
+		return self.map[start:start + length]
+
+	# Binary search the sorted records for a name, returning its index or None
+	def find(self, name):
+		encoded = name.encode('utf-8')
+		low = 0
+		high = self.count
+
+		while (low < high):
+			middle = (low + high) // 2
+			found = self.read_name(middle)
+			if (found < encoded):
+				low = middle + 1
+			elif (found > encoded):
+				high = middle
+			else:
+				return middle
+
+		return None
+
+	def read_field(self, index, field):
+		offsets = self.read_offsets(index)
+		i = record_fields.index(field)
+		return self.read_string(offsets[i * 2], offsets[(i * 2) + 1])
+
+	# All of a record's fields as a dictionary
+	def read_record(self, index):
+		offsets = self.read_offsets(index)
+		variable = dict()
+		for i, field in enumerate(record_fields):
+			variable[field] = self.read_string(offsets[i * 2], offsets[(i * 2) + 1])
+		return variable
+
+	def read_variable(self, index):
+		offsets = self.read_offsets(index)
+		fields = dict()
+		for i, field in enumerate(record_fields):
+			if (field in resident_field_set):
+				fields[field] = self.read_string(offsets[i * 2], offsets[(i * 2) + 1])
+		return Variable(self, index, fields)
+
+	def __getitem__(self, name):
+		variable = self.variables.get(name)
+		if (variable != None):
+			return variable
+
+		if (not isinstance(name, str)):
+			raise KeyError(name)
+
+		index = self.find(name)
+		if (index == None):
+			raise KeyError(name)
+
+		variable = self.read_variable(index)
+		self.variables[name] = variable
+		return variable
+
+	def __contains__(self, name):
+		if (name in self.variables):
+			return True
+		return isinstance(name, str) and self.find(name) != None
+
+	def __iter__(self):
+		for (index,) in order_struct.iter_unpack(self.map[self.order_offset:self.order_offset + (self.count * order_struct.size)]):
+			yield self.read_name(index).decode('utf-8')
+
+	def __len__(self):
+		return self.count
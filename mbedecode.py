@@ -0,0 +1,146 @@
+# mbedecode
+# Vectorised decoding of every data response in a capture
+#
+# Easimap (and mbe) send the same few requests over and over, so responses are grouped by the request they
+# answer. Every response in a group has the same layout: the group's responses are joined into one 2-D numpy
+# array of bytes (a row per response) and each variable is decoded a whole column at a time by viewing its
+# bytes as little endian integers and applying the variable's scale and offset.
+#
+# Variables are found in the request from the page index, bytes with no EC2 variable are skipped. Needs numpy,
+# and pandas for to_dataframe. request_plan, which tools/mbepcap2txt.py decodes with, needs neither.
+#
+
+import logging
+import collections
+import mbedb
+import mbereplay
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+version = "0.1"
+
+# The (name, bytes) of each variable a data request asks for, name is None for bytes with no EC2 variable
+def request_layout(request, page_index):
+	layout = list()
+	if (len(request) < 6):
+		return layout
+
+	page = request[5]
+	i = 6
+	while (i < len(request)):
+		found = page_index.find(page, request[i])
+		if (found == None):
+			found = (1, None)
+		width, name = found
+		layout.append((name, width))
+		i = i + width
+
+	return layout
+
+# A plan for decoding the responses to a data request one at a time, for tools that stream through a capture
+# Returns a list of (name, lsb, offset, width, scale, dividend, minimum) for each variable in the request, where
+# offset is its position in the response, name (and the scaling) is None for bytes with no EC2 variable, or
+# None if this isn't a data request
+def request_plan(request, page_index, variables):
+	if (len(request) < 6):
+		return None
+
+	plan = list()
+	offset = 1 # Skip the 0x81
+	for name, width in request_layout(request, page_index):
+		lsb = request[5 + offset]
+		if (name != None):
+			variable = variables[name]
+			minimum = float(variable['scale_minimum'])
+			scale = float(variable['scale_maximum']) - minimum
+			plan.append((name, lsb, offset, width, scale, (2 ** (width * 8)) - 1, minimum))
+		else:
+			plan.append((None, lsb, offset, width, None, None, None))
+		offset = offset + width
+
+	return plan
+
+# Little endian unsigned integers of width bytes starting at column offset of a 2-D array of bytes
+def column_integers(data, offset, width):
+	if (width == 1):
+		return data[:, offset]
+	if (width in (2, 4)):
+		return numpy.ascontiguousarray(data[:, offset:offset + width]).view('<u' + str(width))[:, 0]
+
+	values = numpy.zeros(len(data), dtype=numpy.uint64)
+	for byte in range(width):
+		values |= data[:, offset + byte].astype(numpy.uint64) << numpy.uint64(8 * byte)
+	return values
+
+# Decode a list of (request time, request, response time, response) exchanges, see mbereplay.read_exchanges
+# Returns a dictionary of variable name -> (timestamps, values) numpy arrays in time order
+def decode_exchanges(exchanges, variables, page_index=None):
+	if (numpy == None):
+		raise ImportError("Vectorised decoding needs numpy")
+
+	if (page_index == None):
+		page_index = mbedb.PageIndex.from_variables(variables)
+
+	groups = collections.defaultdict(lambda: (list(), list()))
+	for request_time, request, response_time, response in exchanges:
+		group = groups[request]
+		group[0].append(response_time)
+		group[1].append(response)
+
+	columns = collections.defaultdict(list)
+
+	for request, (timestamps, responses) in groups.items():
+		layout = request_layout(request, page_index)
+		length = 1 + sum(width for name, width in layout)
+
+		# A response of the wrong length can't be lined up with the others
+		if (any(len(response) != length for response in responses)):
+			kept = [i for i, response in enumerate(responses) if len(response) == length]
+			logging.warning(f"Skipping {len(responses) - len(kept)} responses to {request.hex()} that aren't {length} bytes long")
+			timestamps = [timestamps[i] for i in kept]
+			responses = [responses[i] for i in kept]
+			if (len(responses) == 0):
+				continue
+
+		data = numpy.frombuffer(b''.join(responses), dtype=numpy.uint8).reshape(len(responses), length)
+		times = numpy.array(timestamps, dtype=numpy.float64)
+
+		offset = 1 # Skip the 0x81
+		for name, width in layout:
+			if (name != None):
+				variable = variables[name]
+				minimum = float(variable['scale_minimum'])
+				scale = float(variable['scale_maximum']) - minimum
+				dividend = float((2 ** (width * 8)) - 1)
+				values = (column_integers(data, offset, width).astype(numpy.float64) * scale) / dividend + minimum
+				columns[name].append((times, values))
+			offset = offset + width
+
+	results = dict()
+	for name, parts in columns.items():
+		timestamps = numpy.concatenate([part[0] for part in parts])
+		values = numpy.concatenate([part[1] for part in parts])
+		order = numpy.argsort(timestamps, kind='stable')
+		results[name] = (timestamps[order], values[order])
+
+	return results
+
+# Decode a capture (pcap, pcapng or candump, or an mbereplay index)
+def decode_capture(filename, variables, txid=0x0cbe1101, rxid=0x0cbe0111):
+	return decode_exchanges(mbereplay.load(filename, txid, rxid), variables)
+
+# A long format pandas DataFrame (timestamp, name, value) of every variable in a capture, like mbelog.LogReader.to_dataframe
+def to_dataframe(filename, variables, txid=0x0cbe1101, rxid=0x0cbe0111):
+	import pandas
+
+	frames = list()
+	for name, (timestamps, values) in decode_capture(filename, variables, txid, rxid).items():
+		frames.append(pandas.DataFrame({'timestamp': timestamps, 'name': name, 'value': values}))
+
+	if (len(frames) == 0):
+		return pandas.DataFrame(columns=['timestamp', 'name', 'value'])
+
+	return pandas.concat(frames, ignore_index=True).sort_values('timestamp', kind='stable', ignore_index=True)
@@ -0,0 +1,106 @@
+# mbehistory
+# Fixed size ring buffers of recent samples for the variables an mbe object is following
+#
+# Each variable gets a preallocated numpy array of timestamps (time.monotonic() seconds) and a float32 array
+# of values, recording a sample just overwrites the oldest slot so nothing is allocated per sample.
+# numpy is optional for mbe.py, history just isn't available without it.
+#
+
+import logging
+import time
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+version = "0.1"
+
+default_capacity = 1024
+
+# Samples for one variable, oldest first once the buffer has wrapped
+class RingBuffer():
+	__slots__ = ('timestamps', 'values', 'capacity', 'count')
+
+	def __init__(self, capacity):
+		self.timestamps = numpy.zeros(capacity, dtype=numpy.float64)
+		self.values = numpy.zeros(capacity, dtype=numpy.float32)
+		self.capacity = capacity
+		self.count = 0 # Total samples ever recorded
+
+	def append(self, timestamp, value):
+		i = self.count % self.capacity
+		self.timestamps[i] = timestamp
+		self.values[i] = value
+		self.count = self.count + 1
+
+	def __len__(self):
+		return min(self.count, self.capacity)
+
+	# Return (timestamps, values) for every sample at or after cutoff, in time order
+	# These are views into the buffer unless the samples wrap round its end, in which case they're copies
+	def since(self, cutoff):
+		if (self.count <= self.capacity):
+			timestamps = self.timestamps[:self.count]
+			first = numpy.searchsorted(timestamps, cutoff, side='left')
+			return timestamps[first:], self.values[first:self.count]
+
+		# The oldest sample is where the next one will be written
+		oldest = self.count % self.capacity
+		if (oldest == 0 or cutoff >= self.timestamps[0]):
+			newer = self.timestamps[:oldest] if oldest > 0 else self.timestamps
+			first = numpy.searchsorted(newer, cutoff, side='left')
+			return newer[first:], self.values[first:len(newer)]
+
+		first = oldest + numpy.searchsorted(self.timestamps[oldest:], cutoff, side='left')
+		return (numpy.concatenate((self.timestamps[first:], self.timestamps[:oldest])),
+			numpy.concatenate((self.values[first:], self.values[:oldest])))
+
+	# All the samples we hold, in time order
+	def samples(self):
+		return self.since(-numpy.inf)
+
+	# The most recent (timestamp, value) or None if nothing has been recorded
+	def latest(self):
+		if (self.count == 0):
+			return None
+		i = (self.count - 1) % self.capacity
+		return float(self.timestamps[i]), float(self.values[i])
+
+# Ring buffers for a set of variables, created the first time a variable is recorded
+class History():
+	def __init__(self, capacity=default_capacity):
+		self.capacity = capacity
+		self.buffers = dict()
+
+	def buffer(self, name):
+		buffer = self.buffers.get(name)
+		if (buffer == None):
+			buffer = RingBuffer(self.capacity)
+			self.buffers[name] = buffer
+		return buffer
+
+	def record(self, name, timestamp, value):
+		self.buffer(name).append(timestamp, value)
+
+	# Return (timestamps, values) for a variable over the last seconds, or None if we've never seen it
+	def last(self, name, seconds, now=None):
+		if (not name in self.buffers):
+			return None
+		if (now == None):
+			now = time.monotonic()
+		return self.buffers[name].since(now - seconds)
+
+	def latest(self, name):
+		if (not name in self.buffers):
+			return None
+		return self.buffers[name].latest()
+
+	def __contains__(self, name):
+		return name in self.buffers
+
+	def __iter__(self):
+		return iter(self.buffers)
+
+	def __len__(self):
+		return len(self.buffers)
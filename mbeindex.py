@@ -0,0 +1,189 @@
+# mbeindex
+# Sidecar index of the data request/response exchanges in a capture, for random access by time and variable
+#
+# Building the index reads the capture once and records, for every exchange, where its frames are in the file,
+# when it happened and which request it was. Each distinct request is stored once with its page and the
+# variables it asks for. Queries then only read the part of the capture they need:
+#
+#   index = mbeindex.CaptureIndex.open('captures/Easimap-Engine-Start-and-Running-001.pcapng', variables)
+#   timestamps, values = index.read('RT_ENGINESPEED', 30, 45)
+#
+# The index is saved as JSON next to the capture (<capture>.mbeidx) and rebuilt if the capture changes size or
+# modification time, or if the variables it's opened with put different variables at the addresses (a different
+# EC2 file say). Only pcap and pcapng captures can be indexed, candump logs have no offsets to seek to.
+#
+
+import logging
+import bisect
+import hashlib
+import json
+import os
+import canpcap
+import canisotp
+import mbedb
+import mbedecode
+
+version = "0.1"
+
+index_extension = '.mbeidx'
+
+# A hash of the page, LSB, width and name of every variable, which is everything the index's layouts depend on
+def page_index_fingerprint(page_index):
+	digest = hashlib.sha256()
+	for page in sorted(page_index):
+		for lsb, bytes, name in page_index.entries(page):
+			digest.update(f"{page:x}:{lsb:x}:{bytes}:{name}\n".encode('utf-8'))
+	return digest.hexdigest()
+
+class CaptureIndex():
+	def __init__(self, filename, layouts, entries, size=None, mtime=None, variables=None, fingerprint=None):
+		self.filename = filename
+		self.fingerprint = fingerprint # Of the variables the layouts were worked out with
+		self.variables = variables # Used to decode values
+		self.layouts = layouts # [{'request': hex, 'page': int, 'names': [...]}]
+		self.entries = entries # [[start offset, end offset, request time, response time, layout], ...] in time order
+		self.size = size
+		self.mtime = mtime
+		self.times = [entry[3] for entry in entries]
+		self.start_time = self.times[0] if len(self.times) > 0 else 0.0
+
+	# Read a capture once, pairing up data requests (0x01) and responses (0x81) and recording their offsets
+	@classmethod
+	def build(cls, filename, variables, txid=0x0cbe1101, rxid=0x0cbe0111):
+		page_index = mbedb.PageIndex.from_variables(variables)
+		reassembler = canisotp.Reassembler((txid, rxid))
+		layout_ids = dict()
+		layouts = list()
+		entries = list()
+		message_starts = dict()
+		request = None
+
+		for offset, timestamp, can_id, frame in canpcap.read_packets(filename):
+			if (len(frame) > 0 and (frame[0] >> 4) in (canisotp.single_frame, canisotp.first_frame)):
+				message_starts[can_id] = offset
+
+			message = reassembler.feed(can_id, frame, timestamp)
+			if (message == None):
+				continue
+
+			data = bytes(message.data)
+			if (can_id == txid):
+				request = (message_starts.get(can_id, offset), timestamp, data) if data[:1] == b'\x01' else None
+			elif (can_id == rxid and request != None):
+				if (data[:1] == b'\x81'):
+					layout = layout_ids.get(request[2])
+					if (layout == None):
+						layout = len(layouts)
+						layout_ids[request[2]] = layout
+						names = [name for name, width in mbedecode.request_layout(request[2], page_index) if name != None]
+						layouts.append({'request': request[2].hex(), 'page': request[2][5] if len(request[2]) > 5 else None, 'names': names})
+					# The end offset is the response's last frame, reading stops after the block that starts there
+					entries.append([request[0], offset + 1, request[1], timestamp, layout])
+				request = None
+
+		entries.sort(key=lambda entry: entry[3])
+		stat = os.stat(filename)
+		return cls(filename, layouts, entries, stat.st_size, stat.st_mtime, variables, page_index_fingerprint(page_index))
+
+	def save(self, index_filename=None):
+		if (index_filename == None):
+			index_filename = self.filename + index_extension
+		with open(index_filename, 'w') as f:
+			json.dump({'version': version, 'size': self.size, 'mtime': self.mtime, 'variables': self.fingerprint, 'layouts': self.layouts, 'entries': self.entries}, f, separators=(',', ':'))
+
+	# Load a saved index, returns None if there isn't one, the capture has changed since it was built or it was built
+	# with variables that don't match these (only checked if variables are given)
+	@classmethod
+	def load(cls, filename, variables=None, index_filename=None):
+		if (index_filename == None):
+			index_filename = filename + index_extension
+
+		try:
+			with open(index_filename, 'r') as f:
+				saved = json.load(f)
+		except (OSError, ValueError):
+			return None
+
+		stat = os.stat(filename)
+		if (saved.get('version') != version or saved.get('size') != stat.st_size or saved.get('mtime') != stat.st_mtime):
+			logging.info(f"{index_filename} is out of date")
+			return None
+
+		if (variables != None and saved.get('variables') != page_index_fingerprint(mbedb.PageIndex.from_variables(variables))):
+			logging.info(f"{index_filename} was built with different variables")
+			return None
+
+		return cls(filename, saved['layouts'], saved['entries'], saved['size'], saved['mtime'], variables, saved.get('variables'))
+
+	# Load the index for a capture, building and saving it if it's missing or out of date
+	@classmethod
+	def open(cls, filename, variables, txid=0x0cbe1101, rxid=0x0cbe0111):
+		index = cls.load(filename, variables)
+		if (index == None):
+			index = cls.build(filename, variables, txid, rxid)
+			try:
+				index.save()
+			except OSError as e:
+				logging.warning(f"Unable to save index for {filename}: {e}")
+		return index
+
+	# The names of every variable the capture asked for
+	def names(self):
+		return sorted(set(name for layout in self.layouts for name in layout['names']))
+
+	# Entries for exchanges (optionally only those asking for name) with start <= response time <= end
+	# start and end are seconds from the first exchange in the capture
+	def find(self, name=None, start=None, end=None):
+		first = 0 if start == None else bisect.bisect_left(self.times, self.start_time + start)
+		last = len(self.entries) if end == None else bisect.bisect_right(self.times, self.start_time + end)
+
+		if (name == None):
+			return self.entries[first:last]
+
+		wanted = set(i for i, layout in enumerate(self.layouts) if name in layout['names'])
+		return [entry for entry in self.entries[first:last] if entry[4] in wanted]
+
+	# Read just the exchanges for a set of entries back out of the capture
+	# Returns a list of (request time, request, response time, response), see mbereplay.read_exchanges
+	def read_exchanges(self, entries, txid=0x0cbe1101, rxid=0x0cbe0111):
+		if (len(entries) == 0):
+			return list()
+
+		wanted = set(entry[0] for entry in entries)
+		reassembler = canisotp.Reassembler((txid, rxid))
+		exchanges = list()
+		message_starts = dict()
+		request = None
+
+		# One pass over the part of the file that covers every entry
+		for offset, timestamp, can_id, frame in canpcap.read_packets(self.filename, min(entry[0] for entry in entries), max(entry[1] for entry in entries)):
+			if (len(frame) > 0 and (frame[0] >> 4) in (canisotp.single_frame, canisotp.first_frame)):
+				message_starts[can_id] = offset
+
+			message = reassembler.feed(can_id, frame, timestamp)
+			if (message == None):
+				continue
+
+			data = bytes(message.data)
+			if (can_id == txid):
+				start = message_starts.get(can_id, offset)
+				request = (timestamp, data) if (data[:1] == b'\x01' and start in wanted) else None
+			elif (can_id == rxid and request != None):
+				if (data[:1] == b'\x81'):
+					exchanges.append((request[0], request[1], timestamp, data))
+				request = None
+
+		return exchanges
+
+	# Return (timestamps, values) numpy arrays for a variable between start and end seconds into the capture
+	def read(self, name, start=None, end=None, variables=None, txid=0x0cbe1101, rxid=0x0cbe0111):
+		if (variables == None):
+			variables = self.variables
+		if (variables == None):
+			raise ValueError("Decoding needs the variables file")
+
+		entries = self.find(name, start, end)
+		decoded = mbedecode.decode_exchanges(self.read_exchanges(entries, txid, rxid), variables)
+		if (not name in decoded):
+			return mbedecode.numpy.zeros(0, dtype=mbedecode.numpy.float64), mbedecode.numpy.zeros(0, dtype=mbedecode.numpy.float64)
+		return decoded[name]
@@ -0,0 +1,228 @@
+# mbelog
+# Append only, columnar log file for polled ECU data
+#
+# Samples are buffered per variable and written out in chunks: the chunk's timestamps (float64, time.time()
+# seconds) and values (float32) are stored as two separately zlib compressed columns. When the log is
+# closed a footer indexing every chunk is appended, so a reader can pull out one variable without touching
+# the rest of the file. If a logger dies before writing the footer the chunks can still be found by scanning.
+#
+# Layout (all little endian):
+#   header: file_magic
+#   chunk:  chunk_magic, chunk_struct (name length, sample count, compressed timestamp and value lengths,
+#           first and last timestamp), name (UTF-8), compressed timestamps, compressed values
+#   footer: JSON index of chunks, index length (8 bytes), file_magic
+#
+# The writer only needs the standard library, reading back needs numpy (and pandas for to_dataframe)
+#
+
+import logging
+import array
+import json
+import mmap
+import struct
+import sys
+import zlib
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+version = "0.1"
+
+file_magic = b'MBELOG01'
+chunk_magic = b'MBEC'
+chunk_struct = struct.Struct('<HIIIdd')
+footer_struct = struct.Struct('<Q')
+
+default_chunk_size = 4096
+
+class LogWriter():
+	def __init__(self, filename, chunk_size=default_chunk_size, compression=6):
+		self.filename = filename
+		self.chunk_size = chunk_size
+		self.compression = compression
+		self.file = open(filename, 'wb')
+		self.file.write(file_magic)
+		self.buffers = dict()
+		self.index = list()
+
+	def record(self, name, timestamp, value):
+		buffer = self.buffers.get(name)
+		if (buffer == None):
+			buffer = (array.array('d'), array.array('f'))
+			self.buffers[name] = buffer
+
+		buffer[0].append(timestamp)
+		buffer[1].append(value)
+
+		if (len(buffer[0]) >= self.chunk_size):
+			self.write_chunk(name, buffer)
+
+	def write_chunk(self, name, buffer):
+		timestamps, values = buffer
+		if (len(timestamps) == 0):
+			return
+
+		encoded_name = name.encode('utf-8')
+		timestamp_bytes = timestamps.tobytes()
+		value_bytes = values.tobytes()
+
+		# Columns are always little endian on disk
+		if (sys.byteorder == 'big'):
+			swapped = array.array('d', timestamps)
+			swapped.byteswap()
+			timestamp_bytes = swapped.tobytes()
+			swapped = array.array('f', values)
+			swapped.byteswap()
+			value_bytes = swapped.tobytes()
+
+		compressed_timestamps = zlib.compress(timestamp_bytes, self.compression)
+		compressed_values = zlib.compress(value_bytes, self.compression)
+		offset = self.file.tell()
+
+		self.file.write(chunk_magic)
+		self.file.write(chunk_struct.pack(len(encoded_name), len(timestamps), len(compressed_timestamps), len(compressed_values), timestamps[0], timestamps[-1]))
+		self.file.write(encoded_name)
+		self.file.write(compressed_timestamps)
+		self.file.write(compressed_values)
+
+		self.index.append([name, offset, len(timestamps), timestamps[0], timestamps[-1]])
+
+		del timestamps[:]
+		del values[:]
+
+	# Write out everything that's buffered, the file is still readable by scanning if we stop after this
+	def flush(self):
+		for name, buffer in self.buffers.items():
+			self.write_chunk(name, buffer)
+		self.file.flush()
+
+	def close(self):
+		if (self.file.closed):
+			return
+
+		self.flush()
+		footer = json.dumps({'version': version, 'chunks': self.index}).encode('utf-8')
+		self.file.write(footer)
+		self.file.write(footer_struct.pack(len(footer)))
+		self.file.write(file_magic)
+		self.file.close()
+
+class LogReader():
+	def __init__(self, filename):
+		if (numpy == None):
+			raise ImportError("Reading logs needs numpy")
+
+		# The file is memory mapped so reading one variable from a long log only pages in the footer and its chunks
+		self.filename = filename
+		self.file = open(filename, 'rb')
+		try:
+			self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError:
+			self.file.close()
+			raise ValueError(f"{filename} isn't an mbe log file")
+
+		if (self.data[:len(file_magic)] != file_magic):
+			self.close()
+			raise ValueError(f"{filename} isn't an mbe log file")
+
+		self.index = self.read_footer()
+		if (self.index == None):
+			logging.warning(f"{filename} has no index, it probably wasn't closed properly. Scanning for chunks")
+			self.index = self.scan()
+
+	def close(self):
+		self.data.close()
+		self.file.close()
+
+	def read_footer(self):
+		end = len(self.data) - len(file_magic)
+		if (end < len(file_magic) + footer_struct.size or self.data[end:] != file_magic):
+			return None
+
+		(length,) = footer_struct.unpack_from(self.data, end - footer_struct.size)
+		start = end - footer_struct.size - length
+		if (start < len(file_magic)):
+			return None
+
+		return json.loads(self.data[start:end - footer_struct.size].decode('utf-8'))['chunks']
+
+	# Walk the chunks from the start of the file, stopping at the first incomplete one
+	def scan(self):
+		index = list()
+		offset = len(file_magic)
+
+		while (self.data[offset:offset + len(chunk_magic)] == chunk_magic):
+			header = offset + len(chunk_magic)
+			if (header + chunk_struct.size > len(self.data)):
+				break
+			name_length, count, timestamps_length, values_length, first, last = chunk_struct.unpack_from(self.data, header)
+			end = header + chunk_struct.size + name_length + timestamps_length + values_length
+			if (end > len(self.data)):
+				break
+			name = self.data[header + chunk_struct.size:header + chunk_struct.size + name_length].decode('utf-8')
+			index.append([name, offset, count, first, last])
+			offset = end
+
+		return index
+
+	def read_chunk(self, offset):
+		header = offset + len(chunk_magic)
+		name_length, count, timestamps_length, values_length, first, last = chunk_struct.unpack_from(self.data, header)
+		start = header + chunk_struct.size + name_length
+		timestamps = numpy.frombuffer(zlib.decompress(self.data[start:start + timestamps_length]), dtype='<f8')
+		start = start + timestamps_length
+		values = numpy.frombuffer(zlib.decompress(self.data[start:start + values_length]), dtype='<f4')
+		return timestamps, values
+
+	def names(self):
+		return sorted(set(chunk[0] for chunk in self.index))
+
+	# Return (timestamps, values) numpy arrays for a variable, optionally limited to start <= timestamp <= end
+	def read(self, name, start=None, end=None):
+		timestamps = list()
+		values = list()
+
+		for chunk_name, offset, count, first, last in self.index:
+			if (chunk_name != name):
+				continue
+			if ((start != None and last < start) or (end != None and first > end)):
+				continue
+			chunk_timestamps, chunk_values = self.read_chunk(offset)
+			timestamps.append(chunk_timestamps)
+			values.append(chunk_values)
+
+		if (len(timestamps) == 0):
+			return numpy.zeros(0, dtype=numpy.float64), numpy.zeros(0, dtype=numpy.float32)
+
+		timestamps = numpy.concatenate(timestamps)
+		values = numpy.concatenate(values)
+
+		if (start != None or end != None):
+			keep = numpy.ones(len(timestamps), dtype=bool)
+			if (start != None):
+				keep &= timestamps >= start
+			if (end != None):
+				keep &= timestamps <= end
+			timestamps = timestamps[keep]
+			values = values[keep]
+
+		return timestamps, values
+
+	# A long format pandas DataFrame (timestamp, name, value) of some or all variables
+	def to_dataframe(self, names=None):
+		import pandas
+
+		if (names == None):
+			names = self.names()
+
+		frames = list()
+		for name in names:
+			timestamps, values = self.read(name)
+			frames.append(pandas.DataFrame({'timestamp': timestamps, 'name': name, 'value': values}))
+
+		if (len(frames) == 0):
+			return pandas.DataFrame(columns=['timestamp', 'name', 'value'])
+
+		return pandas.concat(frames, ignore_index=True).sort_values('timestamp', kind='stable', ignore_index=True)
@@ -0,0 +1,145 @@
+# mbereplay
+# Replays ECU data request/response exchanges from the captures in captures/ through the mbe class
+#
+# ReplayTransport stands in for the ISOTP socket: mbe sends it requests and it answers each one with the
+# response the ECU gave to the same request in the capture, either straight away or after the same delay
+# the real ECU took. Exchanges can be pulled out of a capture (see canpcap.py) or from a pre-extracted index file
+# (JSON lines, one exchange per line) which is much quicker to load.
+#
+
+import logging
+import collections
+import json
+import time
+import canpcap
+import canisotp
+
+version = "0.1"
+
+# Pull every data request (0x01) and its response (0x81) out of a capture (pcap, pcapng or candump)
+# Returns a list of (request time, request, response time, response)
+def read_exchanges(filename, txid=0x0cbe1101, rxid=0x0cbe0111):
+	exchanges = list()
+	request = None
+
+	reassembler = canisotp.Reassembler((txid, rxid))
+
+	for message in reassembler.messages(canpcap.read_capture(filename)):
+		data = bytes(message.data)
+		if (message.can_id == txid):
+			if (data[:1] == b'\x01'):
+				request = (message.timestamp, data)
+			else:
+				request = None
+		elif (message.can_id == rxid and request != None):
+			if (data[:1] == b'\x81'):
+				exchanges.append((request[0], request[1], message.timestamp, data))
+			request = None
+
+	return exchanges
+
+# Save exchanges as a JSON lines index file so they can be reloaded without parsing the capture
+def save_exchanges(exchanges, filename):
+	with open(filename, 'w') as f:
+		for request_time, request, response_time, response in exchanges:
+			f.write(json.dumps({'request_time': request_time, 'request': request.hex(), 'response_time': response_time, 'response': response.hex()}) + "\n")
+
+def load_exchanges(filename):
+	exchanges = list()
+	with open(filename, 'r') as f:
+		for line in f:
+			if (line.strip() == ""):
+				continue
+			exchange = json.loads(line)
+			exchanges.append((exchange['request_time'], bytes.fromhex(exchange['request']), exchange['response_time'], bytes.fromhex(exchange['response'])))
+	return exchanges
+
+# Load exchanges from either a capture or an index file
+def load(filename, txid=0x0cbe1101, rxid=0x0cbe0111):
+	if (canpcap.capture_format(filename) == None):
+		with open(filename, 'r', errors='replace') as f:
+			if (f.read(1) == '{'):
+				return load_exchanges(filename)
+	return read_exchanges(filename, txid, rxid)
+
+# Work out which variables the capture was following
+# For each page we take the request that was sent most often and look up the variable at each LSB in it
+# Returns a list of names to follow, the requests mbe builds for them will then match the capture's requests
+# Pages where following the variables wouldn't rebuild the captured request byte for byte are skipped
+def variables_from_exchanges(exchanges, page_index):
+	counts = collections.Counter(request for request_time, request, response_time, response in exchanges)
+	pages = dict()
+
+	for request, count in counts.most_common():
+		if (len(request) > 6 and not request[5] in pages):
+			pages[request[5]] = request
+
+	names = list()
+	for page, request in pages.items():
+		i = 6
+		page_names = list()
+		rebuilt = bytearray(request[:6])
+		while (i < len(request)):
+			found = page_index.find(page, request[i])
+			if (found == None):
+				logging.warning(f"The capture asks for page {page:#04x} LSB {request[i]:02x} which isn't in the variables file, skipping page")
+				page_names = list()
+				break
+			width, name = found
+			page_names.append(name)
+			rebuilt.extend(range(request[i], request[i] + width))
+			# Multi byte variables ask for each of their bytes in turn
+			lsb = request[i]
+			i = i + 1
+			while (i < len(request) and request[i] < lsb + width and request[i] > lsb):
+				i = i + 1
+
+		# Following these has to send exactly the captured request or the replay will never answer it, e.g. when the
+		# capture asked for one byte of what the variables file has as a two byte variable
+		if (len(page_names) > 0 and bytes(rebuilt) != request):
+			logging.warning(f"Following the variables the capture asks for in page {page:#04x} would request {bytes(rebuilt).hex()} not {request.hex()}, skipping page")
+			continue
+		names.extend(page_names)
+
+	return names
+
+# A stand in for the ISOTP socket that answers requests with the responses from a capture
+# Requests that turn up more than once in the capture are answered with each of their responses in turn
+# realtime: wait as long as the ECU took to respond in the capture (divided by speed) before answering
+class ReplayTransport():
+	def __init__(self, exchanges, realtime=False, speed=1.0):
+		self.responses = collections.defaultdict(list)
+		self.positions = collections.Counter()
+		self.pending = collections.deque()
+		self.realtime = realtime
+		self.speed = speed
+		self.unanswered = 0
+
+		for request_time, request, response_time, response in exchanges:
+			self.responses[request].append((response_time - request_time, response))
+
+	def send(self, data):
+		self.pending.append(bytes(data))
+		return len(data)
+
+	def recv(self):
+		if (len(self.pending) == 0):
+			return None
+
+		request = self.pending.popleft()
+		responses = self.responses.get(request)
+		if (responses == None):
+			logging.debug(f"No response in the capture for {request.hex()}")
+			self.unanswered = self.unanswered + 1
+			return None
+
+		latency, response = responses[self.positions[request] % len(responses)]
+		self.positions[request] = self.positions[request] + 1
+
+		if (self.realtime):
+			time.sleep(max(0, latency) / self.speed)
+
+		return response
+
+	def close(self):
+		self.pending.clear()
@@ -0,0 +1,195 @@
+# mbetransport
+# Ways of getting ISOTP messages to and from the ECU, plus a simulated ECU to talk to
+#
+# Every transport has send(data) and recv() (the next message, or None if nothing arrived in time) so
+# mbe.bind() can take any of them:
+#   SocketTransport:    the Linux kernel ISOTP socket, needs the can-isotp kernel module
+#   CanStackTransport:  can-isotp's pure python ISOTP stack on a python-can bus (socketcan, vcan, virtual, ...)
+#   SimulatorTransport: hands requests straight to an in-process SimulatedECU, no CAN needed
+#
+# The ISOTP and CAN libraries are only imported by the transports that need them, so the simulator runs without them
+#
+# SimulatedECU answers 0x01 data requests from the variable database with a configurable latency and jitter.
+# serve() runs it on either of the CAN transports (with the IDs swapped) so it can answer a poller in another
+# process, e.g. over vcan0: see SimECU.py
+#
+
+import logging
+import collections
+import random
+import threading
+import time
+import mbedb
+
+version = "0.1"
+
+# The kernel ISOTP socket
+# The ECU doesn't send flow control frames so we don't wait for them, and we don't wait between consecutive frames
+# timeout: seconds recv() waits before giving up with None, the isotp library's default (finite) timeout if not set
+class SocketTransport():
+	def __init__(self, interface, rxid, txid, timeout=None):
+		import isotp
+
+		if (timeout == None):
+			self.socket = isotp.socket()
+		else:
+			self.socket = isotp.socket(timeout=timeout)
+		self.socket.set_opts(0x480, frame_txtime=0) # 0x400 NOFLOW_MODE, 0x80 FORCESTMIN
+		self.socket.bind(interface, isotp.Address(isotp.AddressingMode.Normal_29bits, rxid=rxid, txid=txid))
+
+	def send(self, data):
+		return self.socket.send(data)
+
+	def recv(self):
+		return self.socket.recv()
+
+	def fileno(self):
+		return self.socket.fileno()
+
+	def settimeout(self, timeout):
+		self.socket.settimeout(timeout)
+
+	def close(self):
+		self.socket.close()
+
+# can-isotp's user space ISOTP stack on a python-can bus, for when the kernel module isn't available
+# bustype is any python-can interface, e.g. 'socketcan' for can0/vcan0 or 'virtual' for an in-process bus
+# Unlike the kernel socket this always waits for flow control when sending multi frame requests
+class CanStackTransport():
+	def __init__(self, interface, rxid, txid, bustype='socketcan', timeout=1.0):
+		import can
+		import isotp
+
+		self.timeout = timeout
+		self.bus = can.interface.Bus(channel=interface, interface=bustype)
+		address = isotp.Address(isotp.AddressingMode.Normal_29bits, rxid=rxid, txid=txid)
+		self.stack = isotp.CanStack(self.bus, address=address, params={'stmin': 0, 'blocksize': 0, 'max_frame_size': 4095})
+		self.stack.start()
+
+	def send(self, data):
+		self.stack.send(data)
+		return len(data)
+
+	def recv(self):
+		return self.stack.recv(block=True, timeout=self.timeout)
+
+	def close(self):
+		self.stack.stop()
+		self.bus.shutdown()
+
+# A simulated 9A4 ECU
+# Holds 256 bytes of memory for every page and answers data requests (01 00000000 <page> <lsbs>) with
+# 81 followed by the requested bytes. Values are set by name and scaled the way mbe decodes them.
+# Pages above 0xff (e.g. 0xfff8) are sent as two bytes, big endian, the way mbe.create_data_request builds them.
+# latency and jitter are in seconds, each response takes latency +/- a uniformly random jitter
+class SimulatedECU():
+	def __init__(self, variables, latency=0.0, jitter=0.0, seed=None):
+		self.variables = variables
+		self.pages = collections.defaultdict(lambda: bytearray(256))
+		# Two byte pages we know about, so we can tell them from a one byte page followed by an LSB
+		self.wide_pages = set(mbedb.variable_location(variables[name])[0] for name in variables) - set(range(0x100))
+		self.latency = latency
+		self.jitter = jitter
+		self.random = random.Random(seed)
+		self.requests = 0
+		self.lock = threading.Lock()
+
+	# Set a variable to a scaled value, clamped to the range its bytes can hold
+	def set_value(self, name, value):
+		variable = self.variables.get(name)
+		if (variable == None):
+			logging.error(f"Unable to set unknown variable {name}")
+			return False
+
+		page, lsb, width = mbedb.variable_location(variable)
+		minimum = float(variable['scale_minimum'])
+		scale = float(variable['scale_maximum']) - minimum
+		maximum = (2 ** (width * 8)) - 1
+
+		if (scale == 0):
+			raw = 0
+		else:
+			raw = min(max(round((value - minimum) / scale * maximum), 0), maximum)
+
+		return self.set_raw(page, lsb, raw.to_bytes(width, byteorder='little'))
+
+	def set_raw(self, page, lsb, data):
+		if (lsb + len(data) > 256):
+			logging.error(f"Unable to write {len(data)} bytes at {lsb:#04x}, past the end of page {page:#04x}")
+			return False
+
+		with self.lock:
+			self.pages[page][lsb:lsb + len(data)] = data
+			if (page > 0xff):
+				self.wide_pages.add(page)
+
+		return True
+
+	# How long the next response takes
+	def delay(self):
+		return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+	# Split a data request into its page and the LSBs it asks for
+	def parse_request(self, request):
+		if (len(request) > 6 and ((request[5] << 8) | request[6]) in self.wide_pages):
+			return (request[5] << 8) | request[6], request[7:]
+		return request[5], request[6:]
+
+	# The response to a request, or None if we don't understand it (the real ECU just doesn't answer)
+	def respond(self, request):
+		if (len(request) < 6 or request[0] != 0x01):
+			logging.debug(f"Ignoring request {bytes(request).hex()}")
+			return None
+
+		self.requests = self.requests + 1
+		with self.lock:
+			page, lsbs = self.parse_request(request)
+			memory = self.pages.get(page)
+			if (memory == None):
+				return b'\x81' + bytes(len(lsbs))
+			return b'\x81' + bytes(memory[lsb] for lsb in lsbs)
+
+	# Answer requests from a CAN transport until stop (a threading.Event) is set
+	# The transport should be opened with the poller's IDs swapped
+	def serve(self, transport, stop=None):
+		while (stop == None or not stop.is_set()):
+			request = transport.recv()
+			if (request == None):
+				continue
+
+			response = self.respond(request)
+			if (response == None):
+				continue
+
+			time.sleep(self.delay())
+			transport.send(response)
+
+# Talk to a SimulatedECU in the same process
+# The ECU handles one request at a time, so with several requests in flight each response is ready a delay
+# after the later of when it was sent and when the previous response was ready
+class SimulatorTransport():
+	def __init__(self, ecu):
+		self.ecu = ecu
+		self.pending = collections.deque()
+		self.ready = 0.0
+
+	def send(self, data):
+		response = self.ecu.respond(data)
+		if (response != None):
+			self.ready = max(time.monotonic(), self.ready) + self.ecu.delay()
+			self.pending.append((self.ready, response))
+		return len(data)
+
+	def recv(self):
+		if (len(self.pending) == 0):
+			return None
+
+		ready, response = self.pending.popleft()
+		wait = ready - time.monotonic()
+		if (wait > 0):
+			time.sleep(wait)
+
+		return response
+
+	def close(self):
+		self.pending.clear()
@@ -0,0 +1,47 @@
+# Tests for mbetransport.SimulatedECU answering mbe's data requests
+# Run with python -m pytest from the top of the repository
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mbe
+import mbetransport
+
+variables_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ec2', '9A4be52a.ec2.utf8.json')
+
+def simulated_ecu(names):
+	ecu = mbe.mbe()
+	assert ecu.set_options(variables_file)
+	assert ecu.add_variable_list_to_follow(names) == len(names)
+	simulator = mbetransport.SimulatedECU(ecu.ecu_variables)
+	assert ecu.bind(mbetransport.SimulatorTransport(simulator))
+	return ecu, simulator
+
+def test_one_byte_page():
+	ecu, simulator = simulated_ecu(['RT_ENGINESPEED'])
+	simulator.set_value('RT_ENGINESPEED', 3000)
+
+	results = ecu.process_all_pages(dict())
+
+	assert results['RT_ENGINESPEED']['value'] == 3000.0
+
+# 0xfff8 is sent as two page bytes, the simulator has to read it that way or its response is a byte too long
+def test_two_byte_page():
+	ecu, simulator = simulated_ecu(['RT_ENGINESPEED', '2D_INTRACYCLETIMES'])
+	simulator.set_value('RT_ENGINESPEED', 3000)
+	simulator.set_raw(0xfff8, 0x5e, b'\x10\x27')
+
+	results = ecu.process_all_pages(dict())
+
+	assert results['RT_ENGINESPEED']['value'] == 3000.0
+	assert abs(results['2D_INTRACYCLETIMES']['value'] - 0x2710 * ecu.get_page_requests(0xfff8)[0][2]['factors'][0]) < 1e-9
+
+def test_two_byte_page_request():
+	ecu, simulator = simulated_ecu(['2D_INTRACYCLETIMES'])
+	simulator.set_raw(0xfff8, 0x5e, b'\x34\x12')
+
+	page, request, plan = ecu.get_page_requests(0xfff8)[0]
+
+	assert request == bytes.fromhex('0100000000fff85e5f')
+	assert simulator.respond(request) == b'\x81\x34\x12'
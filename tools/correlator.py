@@ -1,50 +1,393 @@
 '''
 2019-09-12 Takes a CanBus wireshark .csv export and bitwise looks for a DWORD in it
+
+Frames are loaded once into numpy arrays (from a Wireshark .csv export, or a pcap, pcapng or candump file via
+canpcap.py) and every candidate value, range, width and byte order is searched for at every bit position in one
+vectorised pass, reporting all the hits.
+
+With --correlate it instead takes a variable decoded from the same capture (see mbedecode.py) and ranks every byte
+and 16 bit word of every CAN ID, and every byte of the ISOTP data responses, by Pearson and Spearman correlation
+with it. Bytes Easimap asks for that have no EC2 variable (UNKNOWN in mbepcap2txt.py) show up as their page and LSB.
+
+e.g. look for engine speed 3000 (0x0bb8) and a coolant temperature reading between 0x50 and 0x60:
+python3 correlator.py -f ../captures/Easimap-Engine-Start-and-Running-001.pcapng -d 0bb8 -r 50:60 -w 8,16 -e both
+e.g. find what else follows the engine speed:
+python3 correlator.py -f ../captures/Easimap-car-start-and-run-001.pcapng -c RT_ENGINESPEED
 '''
 
 import argparse
+import logging
 import sys
-import time
+import os
 import csv
 
-# Setup and parse command line args
-parser = argparse.ArgumentParser(prog='correlator', description='Takes a CanBus wireshark .csv export and bitwise looks for a DWORD in it')
-parser.add_argument('--file',          '-f',                   help='Input filename')
-parser.add_argument('--dword',         '-d',                   help='DWORD to look for', )
-parser.add_argument('--id',            '-i',                   help='Only search in messages with this ID (not implemented)')
-parser.add_argument('--version',       '-V', action='version', version='%(prog)s 0.1')
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# canpcap.py lives alongside mbe.py in the directory above
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import canpcap
+import mbedb
+import ec2
+import mbedecode
+import mbereplay
 
-args = parser.parse_args()
+version = "0.2"
 
-if args.file == None or args.dword == None:
-	parser.print_help()
-	exit()
+# Rows of frames searched at a time, keeps the (rows x bit positions) arrays a sensible size
+chunk_rows = 65536
 
-try:
-	dword_int = int(args.dword, 16)
-except ValueError:
-	#Handle the exception
-	print('Please enter an 16bit hex integer for dword')
-	parser.print_help()
-	exit()
-
-print("Using file: ", args.file)
-print("Bitwise search for: ", hex(dword_int))
-
-with open(args.file) as csvfile:
-    readCSV = csv.DictReader(csvfile, delimiter=',')
-    for row in readCSV:
-        data = row['Info'].split(" ")
-
-        if data[0] == "XTD:":
-       		hex_data_as_string = "0x"+data[4]+data[5]+data[6]+data[7]+data[8]+data[9]+data[10]+data[11]
-       		data_integer = int(hex_data_as_string,16)
-
-        	print(f"Row {row['No.']}, Data:0x({data_integer:016x}), 0b({data_integer:064b})")
-
-        	for x in range(48,-1,-1):
-        		shifted_data = data_integer >> x
-        		if (shifted_data & 0xffff) == dword_int:
-        			print("Found something: ")
-        			print(f"Row/Bit: {row['No.']}/{x}, DW: 0x({dword_int:04x}), DW: 0b({dword_int:016b}), Data: 0x({data_integer:016x}), Data: 0b({data_integer:064b}), SHIFTED: {shifted_data & 0xffff:04x}")
-        			exit()
+# Every frame in a capture as numpy arrays, one entry per frame
+# data is the frame's (up to 8) bytes as a big endian 64 bit integer with the first byte in the top bits, like the
+# original correlator built from the Wireshark export
+class Frames():
+	def __init__(self, rows, timestamps, can_ids, lengths, data):
+		self.rows = numpy.asarray(rows, dtype=numpy.int64)
+		self.timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+		self.can_ids = numpy.asarray(can_ids, dtype=numpy.uint32)
+		self.lengths = numpy.asarray(lengths, dtype=numpy.uint8)
+		self.bytes = numpy.asarray(data, dtype=numpy.uint8).reshape(-1, 8)
+		self.data = self.bytes.view('>u8')[:, 0]
+
+	def __len__(self):
+		return len(self.rows)
+
+	# Just the frames with one of these CAN IDs
+	def select(self, can_ids):
+		keep = numpy.isin(self.can_ids, numpy.asarray(list(can_ids), dtype=numpy.uint32))
+		return Frames(self.rows[keep], self.timestamps[keep], self.can_ids[keep], self.lengths[keep], self.bytes[keep])
+
+# Wireshark CSV export, the Info column looks like "XTD: 0x0cbe1101   10 0a 01 00 00 00 00 f8"
+def load_csv(filename):
+	rows = list()
+	timestamps = list()
+	can_ids = list()
+	lengths = list()
+	data = bytearray()
+
+	with open(filename) as csvfile:
+		for row in csv.DictReader(csvfile, delimiter=','):
+			info = row['Info'].split(" ")
+			if (len(info) < 5 or info[0] != "XTD:"):
+				continue
+			frame = bytes.fromhex("".join(info[4:12]))
+			rows.append(int(row['No.']))
+			timestamps.append(float(row.get('Time', 0) or 0))
+			can_ids.append(int(info[1], 16))
+			lengths.append(len(frame))
+			data.extend(frame.ljust(8, b'\x00'))
+
+	return Frames(rows, timestamps, can_ids, lengths, numpy.frombuffer(bytes(data), dtype=numpy.uint8))
+
+# pcap, pcapng or candump via canpcap, rows are numbered from 1 like Wireshark
+def load_capture(filename):
+	rows = list()
+	timestamps = list()
+	can_ids = list()
+	lengths = list()
+	data = bytearray()
+
+	for row, (timestamp, can_id, frame) in enumerate(canpcap.read_capture(filename), start=1):
+		rows.append(row)
+		timestamps.append(timestamp if timestamp != None else 0.0)
+		can_ids.append(can_id)
+		lengths.append(len(frame))
+		data.extend(bytes(frame[:8]).ljust(8, b'\x00'))
+
+	return Frames(rows, timestamps, can_ids, lengths, numpy.frombuffer(bytes(data), dtype=numpy.uint8))
+
+def load_frames(filename):
+	if (filename.lower().endswith('.csv')):
+		return load_csv(filename)
+	return load_capture(filename)
+
+# Swap the bytes of every width bit field in an array of them
+def byteswap_fields(fields, width):
+	swapped = numpy.zeros_like(fields)
+	count = width // 8
+	for byte in range(count):
+		swapped |= ((fields >> numpy.uint64(8 * byte)) & numpy.uint64(0xff)) << numpy.uint64(8 * (count - 1 - byte))
+	return swapped
+
+# A value (low == high) or range of values to look for
+# label is how it was asked for, endian is 'big' or 'little' (little means the bytes are swapped in the frame)
+# low and high are the values themselves, little endian patterns are matched against byte swapped fields
+class Pattern():
+	def __init__(self, label, low, high, width, endian):
+		self.label = label
+		self.low = low
+		self.high = high
+		self.width = width
+		self.endian = endian
+
+	def __repr__(self):
+		return f"{self.label} ({self.width} bit {self.endian} endian)"
+
+# Expand values and ranges into a Pattern for every width and byte order that can hold them
+def make_patterns(values, ranges, widths, endians):
+	patterns = list()
+	for width in widths:
+		maximum = (1 << width) - 1
+		for endian in endians:
+			if (endian == 'little' and width == 8):
+				continue
+			for value in values:
+				if (value > maximum):
+					continue
+				patterns.append(Pattern(f"0x{value:x}", value, value, width, endian))
+			for low, high in ranges:
+				if (low > maximum):
+					continue
+				high = min(high, maximum)
+				patterns.append(Pattern(f"0x{low:x}-0x{high:x}", low, high, width, endian))
+	return patterns
+
+# Search every frame at every bit position for every pattern
+# Fields are cut out (and byte swapped, for little endian patterns) once per width, then exact values are found
+# with one isin and each range with one comparison
+# Returns a list of (frame index, bit position, field value, pattern), bit position counts from the bottom of the
+# 64 bit data like the original correlator (0 is the last bit of the 8th byte). The field value is as it is in the frame
+def search(frames, patterns):
+	hits = list()
+
+	for width in sorted(set(pattern.width for pattern in patterns)):
+		shifts = numpy.arange(64 - width, -1, -1, dtype=numpy.uint64)
+		mask = numpy.uint64((1 << width) - 1)
+		endians = sorted(set(pattern.endian for pattern in patterns if pattern.width == width))
+
+		for first in range(0, len(frames), chunk_rows):
+			data = frames.data[first:first + chunk_rows]
+			fields = (data[:, None] >> shifts[None, :]) & mask
+
+			# Only bit positions that lie wholly inside the frame's data count
+			valid = shifts[None, :] >= (64 - 8 * frames.lengths[first:first + chunk_rows].astype(numpy.uint64))[:, None]
+
+			for endian in endians:
+				values = byteswap_fields(fields, width) if endian == 'little' else fields
+				exact = dict()
+				ranges = list()
+				for pattern in patterns:
+					if (pattern.width != width or pattern.endian != endian):
+						continue
+					if (pattern.low == pattern.high):
+						exact.setdefault(pattern.low, list()).append(pattern)
+					else:
+						ranges.append(pattern)
+
+				if (len(exact) > 0):
+					found = numpy.isin(values, numpy.array(sorted(exact), dtype=numpy.uint64)) & valid
+					for row, column in zip(*numpy.nonzero(found)):
+						for pattern in exact[int(values[row, column])]:
+							hits.append((first + int(row), int(shifts[column]), int(fields[row, column]), pattern))
+
+				for pattern in ranges:
+					found = (values >= numpy.uint64(pattern.low)) & (values <= numpy.uint64(pattern.high)) & valid
+					for row, column in zip(*numpy.nonzero(found)):
+						hits.append((first + int(row), int(shifts[column]), int(fields[row, column]), pattern))
+
+	hits.sort(key=lambda hit: (hit[0], -hit[1]))
+	return hits
+
+# Ranks of values, tied values share the average of their ranks (as Spearman's correlation needs)
+def rank(values):
+	order = numpy.argsort(values, kind='stable')
+	ordered = values[order]
+	starts = numpy.concatenate(([True], ordered[1:] != ordered[:-1]))
+	firsts = numpy.nonzero(starts)[0]
+	counts = numpy.diff(numpy.append(firsts, len(values)))
+	ranks = numpy.empty(len(values), dtype=numpy.float64)
+	ranks[order] = (firsts + (counts - 1) / 2.0)[numpy.cumsum(starts) - 1]
+	return ranks
+
+# Pearson's correlation of two equal length arrays, nan if either is constant
+def pearson(x, y):
+	x = x - x.mean()
+	y = y - y.mean()
+	scale = numpy.sqrt(numpy.dot(x, x) * numpy.dot(y, y))
+	if (scale == 0):
+		return numpy.nan
+	return float(numpy.dot(x, y) / scale)
+
+def spearman(x, y):
+	return pearson(rank(x), rank(y))
+
+# Candidate signals from the raw CAN frames, every byte and every 16 bit word (both byte orders) at every
+# offset of every CAN ID. Frames of one ID with different lengths are kept apart
+# Returns a list of (label, timestamps, values)
+def frame_signals(frames):
+	signals = list()
+	for can_id in numpy.unique(frames.can_ids):
+		for length in numpy.unique(frames.lengths[frames.can_ids == can_id]):
+			keep = (frames.can_ids == can_id) & (frames.lengths == length)
+			timestamps = frames.timestamps[keep]
+			data = frames.bytes[keep].astype(numpy.float64)
+			label = f"ID 0x{int(can_id):08x} len {int(length)}"
+			for offset in range(int(length)):
+				signals.append((f"{label} byte {offset}", timestamps, data[:, offset]))
+			for offset in range(int(length) - 1):
+				signals.append((f"{label} word {offset} big", timestamps, data[:, offset] * 256 + data[:, offset + 1]))
+				signals.append((f"{label} word {offset} little", timestamps, data[:, offset] + data[:, offset + 1] * 256))
+	return signals
+
+# Candidate signals from the ISOTP data responses, every byte the ECU returned labelled with the page and LSB it
+# was asked for (and the EC2 variable there, if there is one), plus little endian words where the request asked for
+# consecutive LSBs. Responses to different requests for the same page and LSB are joined into one signal
+# Returns a list of (label, timestamps, values)
+def response_signals(exchanges, page_index):
+	groups = dict()
+	for request_time, request, response_time, response in exchanges:
+		if (len(request) < 7 or len(response) != len(request) - 5):
+			continue
+		group = groups.setdefault(request, (list(), list()))
+		group[0].append(response_time)
+		group[1].append(response)
+
+	columns = dict()
+	for request, (timestamps, responses) in groups.items():
+		page = request[5]
+		times = numpy.array(timestamps, dtype=numpy.float64)
+		data = numpy.frombuffer(b''.join(responses), dtype=numpy.uint8).reshape(len(responses), len(request) - 5).astype(numpy.float64)
+		for column in range(1, data.shape[1]):
+			lsb = request[5 + column]
+			found = page_index.find(page, lsb)
+			name = f" ({found[1]})" if found != None else ""
+			columns.setdefault(f"page 0x{page:02x} lsb 0x{lsb:02x}{name}", list()).append((times, data[:, column]))
+			if (column + 1 < data.shape[1] and request[6 + column] == lsb + 1):
+				columns.setdefault(f"page 0x{page:02x} lsb 0x{lsb:02x} word{name}", list()).append((times, data[:, column] + data[:, column + 1] * 256))
+
+	signals = list()
+	for label, parts in columns.items():
+		timestamps = numpy.concatenate([part[0] for part in parts])
+		values = numpy.concatenate([part[1] for part in parts])
+		order = numpy.argsort(timestamps, kind='stable')
+		signals.append((label, timestamps[order], values[order]))
+	return signals
+
+# Score every candidate signal against a reference signal, the reference is interpolated to each candidate's
+# timestamps and only the candidate's samples inside the reference's time span are used
+# Returns a list of (label, pearson, spearman, samples), strongest correlation first
+def correlate(signals, reference_times, reference_values, method='spearman'):
+	results = list()
+	for label, timestamps, values in signals:
+		inside = (timestamps >= reference_times[0]) & (timestamps <= reference_times[-1])
+		if (numpy.count_nonzero(inside) < 3):
+			continue
+		x = values[inside]
+		y = numpy.interp(timestamps[inside], reference_times, reference_values)
+		p = pearson(x, y)
+		if (numpy.isnan(p)):
+			continue
+		results.append((label, p, spearman(x, y), len(x)))
+
+	score = 2 if method == 'spearman' else 1
+	results.sort(key=lambda result: -abs(result[score]) if not numpy.isnan(result[score]) else 0)
+	return results
+
+def parse_int(text):
+	return int(text, 16)
+
+# Rank the raw CAN bytes and words and the ISOTP data response bytes against a variable decoded from the capture
+def correlate_main(args, can_ids):
+	variables = ec2.parse(args.variables).variables() if ec2.is_ec2(args.variables) else mbedb.load_json(args.variables)
+	if (not args.correlate in variables):
+		print(f"{args.correlate} isn't in {args.variables}")
+		exit()
+
+	print("Using file: ", args.file)
+	print("Correlating with: ", args.correlate)
+
+	exchanges = mbereplay.load(args.file)
+	page_index = mbedb.PageIndex.from_variables(variables)
+	decoded = mbedecode.decode_exchanges(exchanges, variables, page_index)
+	if (not args.correlate in decoded or len(decoded[args.correlate][0]) < 3):
+		print(f"{args.correlate} isn't in {args.file}")
+		exit()
+	reference_times, reference_values = decoded[args.correlate]
+	if (reference_values.min() == reference_values.max()):
+		print(f"{args.correlate} doesn't change in {args.file}, there's nothing to correlate with")
+		exit()
+
+	frames = load_frames(args.file)
+	if (len(can_ids) > 0):
+		frames = frames.select(can_ids)
+
+	signals = frame_signals(frames) + response_signals(exchanges, page_index)
+	results = correlate(signals, reference_times, reference_values, args.method)
+
+	for label, p, s, samples in results[:args.top]:
+		print(f"{label:<60} Pearson: {p:+.3f}, Spearman: {s:+.3f}, Samples: {samples}")
+
+	print(f"{len(results)} signals correlated against {len(reference_times)} samples of {args.correlate}")
+
+def main():
+	# Setup and parse command line args
+	parser = argparse.ArgumentParser(prog='correlator', description='Takes a CanBus capture (wireshark .csv export, pcap, pcapng or candump) and bitwise looks for values in it')
+	parser.add_argument('--file',          '-f',                   help='Input filename')
+	parser.add_argument('--dword',         '-d', action='append',  help='Hex value to look for (can be repeated)', default=[])
+	parser.add_argument('--range',         '-r', action='append',  help='Hex range LOW:HIGH to look for (can be repeated)', default=[])
+	parser.add_argument('--width',         '-w',                   help='Comma separated widths in bits to search, 8, 16 and/or 32 (default 16)', default='16')
+	parser.add_argument('--endian',        '-e',                   help='Byte order of the values (default big)', choices=['big', 'little', 'both'], default='big')
+	parser.add_argument('--id',            '-i', action='append',  help='Only search in messages with this ID (hex, can be repeated)', default=[])
+	parser.add_argument('--correlate',     '-c',                   help='Rank every byte and word in the capture by how well it follows this EC2 variable (e.g. RT_ENGINESPEED)')
+	parser.add_argument('--variables',     '-v',                   help='MBE variables filename (JSON or EC2), needed by --correlate', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ec2', '9A4be52a.ec2.utf8.json'))
+	parser.add_argument('--method',        '-m',                   help='Correlation to rank by (default spearman)', choices=['pearson', 'spearman'], default='spearman')
+	parser.add_argument('--top',           '-t',                   help='Number of correlations to show (default 20)', type=int, default=20)
+	parser.add_argument('--first',         '-1', action='store_true', help='Stop at the first hit, like the original correlator')
+	parser.add_argument('--loglevel',      '-l',                   help='Logging level to show', choices=['INFO','DEBUG','WARNING', 'ERROR', 'NONE'], default="WARNING")
+	parser.add_argument('--version',       '-V', action='version', version='%(prog)s '+version)
+
+	args = parser.parse_args()
+
+	logging.basicConfig(level=getattr(logging, args.loglevel, None))
+
+	if args.file == None or (len(args.dword) == 0 and len(args.range) == 0 and args.correlate == None):
+		parser.print_help()
+		exit()
+
+	if (numpy == None):
+		print("The correlator needs numpy")
+		exit()
+
+	try:
+		values = [parse_int(value) for value in args.dword]
+		ranges = [tuple(parse_int(part) for part in text.split(':', 1)) for text in args.range]
+		widths = [int(width) for width in args.width.split(',')]
+		can_ids = [parse_int(can_id) for can_id in args.id]
+	except ValueError:
+		#Handle the exception
+		print('Please enter values, ranges and IDs as hex integers and widths as 8, 16 or 32')
+		parser.print_help()
+		exit()
+
+	if (any(not width in (8, 16, 32) for width in widths)):
+		print('Widths must be 8, 16 or 32')
+		exit()
+
+	if (args.correlate != None):
+		correlate_main(args, can_ids)
+		return
+
+	endians = ['big', 'little'] if args.endian == 'both' else [args.endian]
+	patterns = make_patterns(values, ranges, widths, endians)
+
+	print("Using file: ", args.file)
+	print("Bitwise search for: ", ", ".join(repr(pattern) for pattern in patterns[:20]) + (" ..." if len(patterns) > 20 else ""))
+
+	frames = load_frames(args.file)
+	if (len(can_ids) > 0):
+		frames = frames.select(can_ids)
+
+	hits = search(frames, patterns)
+
+	for index, bit, value, pattern in hits:
+		data = int(frames.data[index])
+		print(f"Row/Bit: {frames.rows[index]}/{bit}, ID: 0x{int(frames.can_ids[index]):08x}, Time: {frames.timestamps[index]:.6f}, Pattern: {pattern}, Found: 0x{value:0{pattern.width // 4}x}, Data: 0x({data:016x}), Data: 0b({data:064b})")
+		if (args.first):
+			break
+
+	print(f"{len(hits)} hits in {len(frames)} frames")
+
+if __name__ == '__main__':
+	main()
@@ -3,17 +3,10 @@
 #
 # 2019-08-20 John Martin
 #
+# Captures are read with canpcap.py (pcap, pcapng or candump output, - for stdin) and ISOTP messages are
+# reassembled with canisotp.py, so neither Wireshark nor pyshark is needed
+#
 
-# Here's some useful commands for python
-# import pyshark
-# packets = pyshark.FileCapture('Easimap talking to Caterham only ISOTP frames.pcapng', decode_as={'can.subdissector':'iso15765'})
-# pkt0 = packets[0]
-# >>> pkt0.layers
-# [<SLL Layer>, <CAN Layer>, <ISO15765 Layer>, <DATA Layer>]
-# 
-# And a useful tshark command...
-# tshark -r Easimap\ talking\ to\ Caterham\ only\ ISOTP\ frames.pcapng -Y '(frame.number == 3)' -T pdml -d can.subdissector=iso15765
-# 
 # Example command line:
 # python3 mbepcap2txt.py -i ../captures/Easimap-Engine-Start-and-Running-001-ISO-only.pcapng -v ../ec2/9A4be52a.ec2.utf8.json -q 0x0cbe1101 -r 0x0cbe0111
 #
@@ -24,12 +17,23 @@ import re
 import csv
 import json
 import pprint
-import pyshark
 import binascii
+import os
+import sys
+
+# mbedb.py, ec2.py, canpcap.py and canisotp.py live alongside mbe.py in the directory above
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mbedb
+import ec2
+import canpcap
+import canisotp
 
 version = "0.1"
 
 def load_mbe_variables(filename):
+	# An EC2 file is parsed directly (see ec2.py), otherwise it's the JSON made from one by ec2parse.py
+	if (ec2.is_ec2(filename)):
+		return ec2.parse(filename).variables()
 	f = open(filename, "r")
 	variables = dict()
 	variables = json.load(f)
@@ -37,41 +41,30 @@ def load_mbe_variables(filename):
 	#    logging.debug(v['name'])
 	return variables
 
+# Integer keyed index of page -> LSB -> (bytes, name), see mbedb.PageIndex
 def create_page_reverse_mapping(variables):
-	mapping = dict()
-	for i in variables:
-		LSBstring = variables[i]['address'][-2:]
-		if(not variables[i]['page'] in mapping):
-			mapping[variables[i]['page']] = dict()
-		mapping[variables[i]['page']][LSBstring] = variables[i]['bytes']
-		# Possibly don't need to store bytes as well as name... could get it from the main variables list, but what the heck
-		mapping[variables[i]['page']][LSBstring] = {'name':variables[i]['name'], 'bytes':variables[i]['bytes']}
-	#pprint.pprint(mapping)
-	return mapping
+	return mbedb.PageIndex.from_variables(variables)
 
 def process_data_request_command(data, mapping):
 	# Build a format array
 	# 0100000000126667a8a9
 	command_structure = list()
-	data_length = len(data)
-	if (data_length < 12):
+	request = binascii.unhexlify(data)
+	data_length = len(request)
+	if (data_length < 6):
 		return None
 	# Get the page number
-	page = data[10:12]
-	logging.debug(f"This is a command request for data in page: {page} ...")
+	page = request[5]
+	logging.debug(f"This is a command request for data in page: {page:02x} ...")
 	# Iterate through the remaining message and lookup the number of bytes to extract in the response
-	i = 12
+	i = 6
 	while(i < data_length):
-		byte = data[i:i+2]
-		#logging.debug(f"{byte} ")
-		try:
-			mapped = mapping["0x"+page][byte]
-		except:
-			mapped = {'name':"UNKNOWN", 'bytes':"1"}
-		bytes = mapped['bytes']
-		#pprint.pprint(mapped)
-		command_structure.append(mapped)
-		i = i + (int(bytes) * 2)
+		mapped = mapping.find(page, request[i])
+		if (mapped == None):
+			mapped = (1, "UNKNOWN")
+		bytes, name = mapped
+		command_structure.append({'name':name, 'bytes':bytes})
+		i = i + bytes
 	logging.debug(pprint.pformat(command_structure))
 	return command_structure
 
@@ -121,7 +114,7 @@ def process_data_response(data, request_command, variables):
 def main():
 	# Setup and parse command line args
 	parser = argparse.ArgumentParser(prog='mbepcap2txt', description='Takes an pcap with ISOTP formatted MBE transactions and makes it human readable.')
-	parser.add_argument('--input',         '-i',                   help='Input pcap filename', required=True)
+	parser.add_argument('--input',         '-i',                   help='Input pcap, pcapng or candump filename (- for candump on stdin)', required=True)
 	parser.add_argument('--can',           '-c',                   help='Display raw can data', action='store_true', default=False)
 	parser.add_argument('--isotp',         '-I',                   help='Display raw isotp data', action='store_true', default=False)
 	parser.add_argument('--mbe',           '-m',                   help='DON\'T Display mbe decoded data', action='store_false', default=True)
@@ -144,44 +137,31 @@ def main():
 	variables = load_mbe_variables(args.variables)
 	mappings = create_page_reverse_mapping(variables)
 
-	cap = pyshark.FileCapture(args.input, decode_as={'can.subdissector':'iso15765'}, keep_packets=False)
+	query_id = int(args.query_id, 0)
+	response_id = int(args.response_id, 0)
+	reassembler = canisotp.Reassembler((query_id, response_id))
+	pending_data_request_command = None
 
 	i = 0
 
-	for pkt in cap:
+	for timestamp, can_id, frame in canpcap.read_capture(args.input):
 		i = i + 1
-		#Need to check we have a packet with CAN and ISOTP layers
-		try:
-			if(pkt.can != None): has_can = True
-		except:
-		  has_can = False
-		try:
-			if(pkt.iso15765 != None): has_isotp = True
-		except:
-			has_isotp = False
-
-		if (not ((has_can) and (has_isotp))):
-			logging.debug("Bummer, not a can/iso15765 packet")
-			logging.debug(pprint.pformat(pkt.layers))
-			continue
-
-		can_id = pkt.can.id
 
-		if(can_id != args.query_id and can_id != args.response_id):
+		if(can_id != query_id and can_id != response_id):
 	  		logging.debug("This isn't a packet we're interested in")
 	  		continue
 
-		data = pkt.data.data
 		# Message Types: 0x00=Single Frame, 0x01=First Frame, 0x02=Consecutive Frame
-		message_type = int(pkt.iso15765.message_type[2:])
-		try:
-			fragment_count = int(pkt.iso15765.fragment_count)
-		except:
-			fragment_count = 0
+		message_type, fragment_count, payload = reassembler.feed_frame(can_id, frame, timestamp)
+		if (message_type == None):
+			logging.debug("Bummer, not an ISOTP data frame")
+			continue
+
+		data = payload.hex()
 
 		output_log_line = False
 		if (args.can):
-			can_string = f"CAN ID={can_id}"
+			can_string = f"CAN ID={can_id:#010x}"
 			output_log_line = True
 			output_data = data
 		else:
@@ -190,14 +170,14 @@ def main():
 		command_string = ""
 		if(args.isotp and (message_type == 0x00 or fragment_count > 0)):
 			command = data[:2]
-			if (can_id == args.query_id):
+			if (can_id == query_id):
 				if (command == "01"):
 					command_string = "REQUEST "
 				elif (command == '04'):
 					command_string = "OTHER_REQUEST"
 				else:
 					command_string = "UNKNOWN_MBE_MESSAGE"
-			elif (can_id == args.response_id):
+			elif (can_id == response_id):
 				if (command == '81'):
 					command_string = "RESPONSE"
 				elif (command == 'e4'):
@@ -214,26 +194,23 @@ def main():
 			print(f"#[{i+1}]# {can_string}{isotp_string}:{output_data}")
 
 		if (args.mbe):
-			if (can_id == args.query_id):
-				# If its a single frame then process it, otherwise wait for the final frame that has fragment_count set
+			if (can_id == query_id):
+				# If its a single frame then process it, otherwise wait for the final frame that completes the message
 				if(message_type == 0x00 or fragment_count > 0):
 					command = data[:2]
 					if(command == "01"): # A data request
 						pending_data_request_command = process_data_request_command(data, mappings)
 					elif(command == "04"):
 						logging.debug("This is a config request")
-			elif (can_id == args.response_id):
-				# If its a single frame then process it, otherwise wait for the final frame that has fragment_count set
+			elif (can_id == response_id):
+				# If its a single frame then process it, otherwise wait for the final frame that completes the message
 				if(message_type == 0x00 or fragment_count > 0):
 					command = data[:2]
-					if(command == "81"): # A data response
+					if(command == "81" and pending_data_request_command != None): # A data response
 						process_data_response(data, pending_data_request_command, variables)
 					elif(command == "e4"):
 						logging.debug("This is a config response")
 
-	cap.close()
-
-
 if __name__ == '__main__':
 	main()
 
@@ -3,20 +3,20 @@
 #
 # 2019-08-20 John Martin
 #
+# Captures are read with canpcap.py (pcap, pcapng or candump output, - for stdin) and ISOTP messages are
+# reassembled with canisotp.py, so neither Wireshark nor pyshark is needed
+#
 
-# Here's some useful commands for python
-# import pyshark
-# packets = pyshark.FileCapture('Easimap talking to Caterham only ISOTP frames.pcapng', decode_as={'can.subdissector':'iso15765'})
-# pkt0 = packets[0]
-# >>> pkt0.layers
-# [<SLL Layer>, <CAN Layer>, <ISO15765 Layer>, <DATA Layer>]
-# 
-# And a useful tshark command...
-# tshark -r Easimap\ talking\ to\ Caterham\ only\ ISOTP\ frames.pcapng -Y '(frame.number == 3)' -T pdml -d can.subdissector=iso15765
-# 
 # Example command line:
 # python3 mbepcap2txt.py -i ../captures/Easimap-Engine-Start-and-Running-001-ISO-only.pcapng -v ../ec2/9A4be52a.ec2.utf8.json -q 0x0cbe1101 -r 0x0cbe0111
 #
+# Batch mode, every capture in a directory decoded by one process per CPU, output merged in timestamp order:
+# python3 mbepcap2txt.py -i ../captures -v ../ec2/9A4be52a.ec2.utf8.json -j 0
+#
+# Structured output (-F): csv and jsonl give a row per variable per response, wide a row per response with a
+# column per variable, columnar an mbelog.py file of compressed per variable columns
+# python3 mbepcap2txt.py -i ../captures/Easimap-RPM-Only.pcap -v ../ec2/9A4be52a.ec2.utf8.json -F csv -o rpm.csv
+#
 
 import logging
 import argparse
@@ -24,12 +24,27 @@ import re
 import csv
 import json
 import pprint
-import pyshark
 import binascii
+import os
+import sys
+import concurrent.futures
+import heapq
+
+# mbedb.py, ec2.py, mbelog.py, canpcap.py and canisotp.py live alongside mbe.py in the directory above
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mbedb
+import ec2
+import mbelog
+import canpcap
+import canisotp
+import mbedecode
 
 version = "0.1"
 
 def load_mbe_variables(filename):
+	# An EC2 file is parsed directly (see ec2.py), otherwise it's the JSON made from one by ec2parse.py
+	if (ec2.is_ec2(filename)):
+		return ec2.parse(filename).variables()
 	f = open(filename, "r")
 	variables = dict()
 	variables = json.load(f)
@@ -37,151 +52,198 @@ def load_mbe_variables(filename):
 	#    logging.debug(v['name'])
 	return variables
 
+# Integer keyed index of page -> LSB -> (bytes, name), see mbedb.PageIndex
 def create_page_reverse_mapping(variables):
-	mapping = dict()
-	for i in variables:
-		LSBstring = variables[i]['address'][-2:]
-		if(not variables[i]['page'] in mapping):
-			mapping[variables[i]['page']] = dict()
-		mapping[variables[i]['page']][LSBstring] = variables[i]['bytes']
-		# Possibly don't need to store bytes as well as name... could get it from the main variables list, but what the heck
-		mapping[variables[i]['page']][LSBstring] = {'name':variables[i]['name'], 'bytes':variables[i]['bytes']}
-	#pprint.pprint(mapping)
-	return mapping
-
-def process_data_request_command(data, mapping):
-	# Build a format array
-	# 0100000000126667a8a9
-	command_structure = list()
-	data_length = len(data)
-	if (data_length < 12):
-		return None
-	# Get the page number
-	page = data[10:12]
-	logging.debug(f"This is a command request for data in page: {page} ...")
-	# Iterate through the remaining message and lookup the number of bytes to extract in the response
-	i = 12
-	while(i < data_length):
-		byte = data[i:i+2]
-		#logging.debug(f"{byte} ")
-		try:
-			mapped = mapping["0x"+page][byte]
-		except:
-			mapped = {'name':"UNKNOWN", 'bytes':"1"}
-		bytes = mapped['bytes']
-		#pprint.pprint(mapped)
-		command_structure.append(mapped)
-		i = i + (int(bytes) * 2)
-	logging.debug(pprint.pformat(command_structure))
-	return command_structure
-
-def process_data_response(data, request_command, variables):
+	return mbedb.PageIndex.from_variables(variables)
+
+# Decode a data response into a record for each variable in the request, using the request's decode plan
+# (see mbedecode.request_plan). value (and the scaling fields) are None for bytes that have no EC2 variable
+def decode_data_response(response, plan, variables):
 	#81aaaa1600
-	data_length = len(data)
-	if (data_length < 4):
-		return None
-	i = 2
-	response_count = 1
-	logging.debug(f"This is a command response for data...")
-	for command in request_command:
-		logging.debug(f"\nResponse: {response_count}")
-
-		variable = None
-
-		response_data = ""
-		if (command['name'] != "UNKNOWN"):
-			logging.debug(f"This is the variable info for {command['name']}")
-			variable = variables[command['name']]
-			logging.debug(pprint.pformat(variable))
-			bytes = int(command['bytes'])
-			for y in range (0,bytes):
-				byte = data[i+(y*2):(i+(y*2))+2]
-				response_data = str(byte) + str(response_data)
-		else:
-			logging.debug(f"There is no EC2 variable for {command['name']}")
-			bytes = int(command['bytes'])
-			for y in range (0,bytes):
-				byte = data[i+(y*2):(i+(y*2))+2]
-				response_data = str(byte) + str(response_data) # This is the right byte orientation
-
-		i = i + (bytes*2)
-		response_count = response_count + 1
-
-		if(variable != None):
-			scale = float(variable['scale_maximum']) - float(variable['scale_minimum'])
-			dividend = (2 ** (int(variable['bytes']) * 8)) - 1
-			response_int = int(response_data,16)
-			response_scaled = ((float(response_int * scale)) / float(dividend)) + float(variable['scale_minimum'])
-			offset = float(variable['scale_minimum'])
-			print(f"{command['name']}={response_scaled:.5} {variable['units']} ({variable['short_desc']} ) [0x{response_data}={int('0x'+response_data, 16)}, Scale:{scale}, Div:{dividend}, Offset:{offset:4}]")
+	records = list()
+	if (len(response) < 2):
+		return records
+
+	for name, lsb, offset, width, scale, dividend, minimum in plan:
+		# The ECU sends little endian, raw is shown most significant byte first
+		data = response[offset:offset + width]
+		raw_int = int.from_bytes(data, byteorder='little')
+		record = {'name': name, 'lsb': lsb, 'raw': bytes(data[::-1]).hex(), 'raw_int': raw_int, 'value': None, 'units': None, 'short_desc': None, 'scale': None, 'dividend': None, 'offset': None}
+
+		if (name != None):
+			variable = variables[name]
+			record.update({'value': ((raw_int * scale) / float(dividend)) + minimum, 'units': variable['units'], 'short_desc': variable['short_desc'], 'scale': scale, 'dividend': dividend, 'offset': minimum})
 		else:
-			print(f"{command['name']}: 0x{response_data}, {int('0x'+response_data, 16)}")
+			record['name'] = "UNKNOWN"
+
+		records.append(record)
+	return records
+
+# The human readable line for a decoded variable
+def format_data_record(record):
+	if (record['value'] != None):
+		return f"{record['name']}={record['value']:.5} {record['units']} ({record['short_desc']} ) [0x{record['raw']}={record['raw_int']}, Scale:{record['scale']}, Div:{record['dividend']}, Offset:{record['offset']:4}]"
+	return f"{record['name']}: 0x{record['raw']}, {record['raw_int']}"
+
+# output is called with each decoded line
+def process_data_response(response, plan, variables, output=print):
+	for record in decode_data_response(response, plan, variables):
+		output(format_data_record(record))
 	return None
 
-def main():
-	# Setup and parse command line args
-	parser = argparse.ArgumentParser(prog='mbepcap2txt', description='Takes an pcap with ISOTP formatted MBE transactions and makes it human readable.')
-	parser.add_argument('--input',         '-i',                   help='Input pcap filename', required=True)
-	parser.add_argument('--can',           '-c',                   help='Display raw can data', action='store_true', default=False)
-	parser.add_argument('--isotp',         '-I',                   help='Display raw isotp data', action='store_true', default=False)
-	parser.add_argument('--mbe',           '-m',                   help='DON\'T Display mbe decoded data', action='store_false', default=True)
-	parser.add_argument('--variables',     '-v',                   help='Input MBE variables filename', required=True)
-	parser.add_argument('--query_id',      '-q',                   help='CAN query ID (default 0x0cbe1101)', default='0x0cbe1101')
-	parser.add_argument('--response_id',   '-r',                   help='CAN resdponse ID (default 0x0cbe0111)', default='0x0cbe0111')
-	parser.add_argument('--loglevel',      '-l',                   help='Logging level to show', choices=['INFO','DEBUG','WARNING', 'ERROR', 'NONE'], default="INFO")
-	parser.add_argument('--logfile',       '-f',                   help='If set logging will be sent to this file')
-	parser.add_argument('--version',       '-V', action='version', version='%(prog)s '+version)
+# Output writers, each has line(timestamp, text) for the raw CAN/ISOTP lines, response(timestamp, page, records) for
+# decoded data responses and close(). Everything but text ignores the raw lines.
+output_buffer_size = 1024 * 1024
 
-	args = parser.parse_args()
+def open_output(filename):
+	if (filename == None):
+		return sys.stdout
+	return open(filename, 'w', newline='', buffering=output_buffer_size)
 
-	logging_level = getattr(logging, args.loglevel, None)
-	logging.basicConfig(level=logging_level, filename=args.logfile, filemode='w')
+# The original human readable output
+class TextWriter():
+	def __init__(self, filename):
+		self.file = open_output(filename)
 
-	if args.input == None:
-		parser.print_help()
-		exit()
+	def line(self, timestamp, text):
+		self.file.write(text + "\n")
 
-	variables = load_mbe_variables(args.variables)
-	mappings = create_page_reverse_mapping(variables)
+	def response(self, timestamp, page, records):
+		for record in records:
+			self.file.write(format_data_record(record) + "\n")
 
-	cap = pyshark.FileCapture(args.input, decode_as={'can.subdissector':'iso15765'}, keep_packets=False)
+	def close(self):
+		if (self.file != sys.stdout):
+			self.file.close()
+		else:
+			self.file.flush()
 
-	i = 0
+# One row per variable per response
+class CsvWriter(TextWriter):
+	fields = ['timestamp', 'page', 'name', 'value', 'units', 'raw', 'short_desc']
 
-	for pkt in cap:
-		i = i + 1
-		#Need to check we have a packet with CAN and ISOTP layers
-		try:
-			if(pkt.can != None): has_can = True
-		except:
-		  has_can = False
-		try:
-			if(pkt.iso15765 != None): has_isotp = True
-		except:
-			has_isotp = False
-
-		if (not ((has_can) and (has_isotp))):
-			logging.debug("Bummer, not a can/iso15765 packet")
-			logging.debug(pprint.pformat(pkt.layers))
-			continue
+	def __init__(self, filename):
+		super().__init__(filename)
+		self.writer = csv.writer(self.file)
+		self.writer.writerow(self.fields)
+
+	def line(self, timestamp, text):
+		return
+
+	def response(self, timestamp, page, records):
+		self.writer.writerows([(timestamp, f"{page:02x}", record['name'], record['value'], record['units'], record['raw'], record['short_desc']) for record in records])
+
+# One JSON object per variable per response
+class JsonLinesWriter(TextWriter):
+	def line(self, timestamp, text):
+		return
+
+	def response(self, timestamp, page, records):
+		for record in records:
+			self.file.write(json.dumps({'timestamp': timestamp, 'page': f"{page:02x}", 'name': record['name'], 'value': record['value'], 'units': record['units'], 'raw': record['raw'], 'short_desc': record['short_desc']}) + "\n")
+
+# One row per response with a column for every variable, only known once every response has been seen
+# so rows are held (as compactly as we can) until close
+class WideWriter(TextWriter):
+	def __init__(self, filename):
+		super().__init__(filename)
+		self.columns = dict()
+		self.layouts = dict()
+		self.rows = list()
+
+	def line(self, timestamp, text):
+		return
+
+	def response(self, timestamp, page, records):
+		# Bytes with no EC2 variable get a column each, named by their page and LSB
+		layout = tuple(record['name'] if record['value'] != None else f"UNKNOWN_{page:02x}{record['lsb']:02x}" for record in records)
+		layout_id = self.layouts.get(layout)
+		if (layout_id == None):
+			layout_id = len(self.layouts)
+			self.layouts[layout] = layout_id
+			for name in layout:
+				self.columns.setdefault(name, len(self.columns))
+		self.rows.append((timestamp, page, layout_id, tuple(record['value'] if record['value'] != None else record['raw_int'] for record in records)))
+
+	def close(self):
+		writer = csv.writer(self.file)
+		writer.writerow(['timestamp', 'page'] + list(self.columns))
+		layouts = [[self.columns[name] for name in layout] for layout in self.layouts]
+		for timestamp, page, layout_id, values in self.rows:
+			row = [None] * len(self.columns)
+			for column, value in zip(layouts[layout_id], values):
+				row[column] = value
+			writer.writerow([timestamp, f"{page:02x}"] + row)
+		super().close()
+
+# Compressed per variable columns of timestamps and values, see mbelog.py (needs an output filename)
+# Bytes with no EC2 variable aren't logged
+class ColumnarWriter():
+	def __init__(self, filename):
+		if (filename == None):
+			raise ValueError("The columnar format needs an output filename")
+		self.log = mbelog.LogWriter(filename)
+
+	def line(self, timestamp, text):
+		return
+
+	def response(self, timestamp, page, records):
+		for record in records:
+			if (record['value'] != None):
+				self.log.record(record['name'], timestamp, record['value'])
+
+	def close(self):
+		self.log.close()
+
+output_formats = {'text': TextWriter, 'csv': CsvWriter, 'jsonl': JsonLinesWriter, 'wide': WideWriter, 'columnar': ColumnarWriter}
+
+# Collects everything a worker decodes in batch mode so it can be merged and written by the main process
+class CollectingWriter():
+	def __init__(self):
+		self.entries = list()
 
-		can_id = pkt.can.id
+	def line(self, timestamp, text):
+		self.entries.append((timestamp, text, None, None))
 
-		if(can_id != args.query_id and can_id != args.response_id):
+	def response(self, timestamp, page, records):
+		self.entries.append((timestamp, None, page, records))
+
+# Decode a capture (or the byte range start to end of one, see canpcap.split_capture) to a writer as we go
+# frame_number is the number of frames before start so the frame numbers match decoding the whole file
+def decode_capture(filename, args, variables, mappings, writer, start=None, end=None, frame_number=0):
+	query_id = int(args.query_id, 0)
+	response_id = int(args.response_id, 0)
+	reassembler = canisotp.Reassembler((query_id, response_id))
+	pending_plan = None
+	pending_page = None
+	# Easimap repeats the same few requests, so each one's decode plan is only built once
+	plans = dict()
+
+	if (start == None and end == None):
+		frames = canpcap.read_capture(filename)
+	else:
+		frames = canpcap.read_frames(filename, start, end)
+
+	i = frame_number
+
+	for timestamp, can_id, frame in frames:
+		i = i + 1
+
+		if(can_id != query_id and can_id != response_id):
 	  		logging.debug("This isn't a packet we're interested in")
 	  		continue
 
-		data = pkt.data.data
 		# Message Types: 0x00=Single Frame, 0x01=First Frame, 0x02=Consecutive Frame
-		message_type = int(pkt.iso15765.message_type[2:])
-		try:
-			fragment_count = int(pkt.iso15765.fragment_count)
-		except:
-			fragment_count = 0
+		message_type, fragment_count, payload = reassembler.feed_frame(can_id, frame, timestamp)
+		if (message_type == None):
+			logging.debug("Bummer, not an ISOTP data frame")
+			continue
+
+		data = payload.hex()
 
 		output_log_line = False
 		if (args.can):
-			can_string = f"CAN ID={can_id}"
+			can_string = f"CAN ID={can_id:#010x}"
 			output_log_line = True
 			output_data = data
 		else:
@@ -190,14 +252,14 @@ def main():
 		command_string = ""
 		if(args.isotp and (message_type == 0x00 or fragment_count > 0)):
 			command = data[:2]
-			if (can_id == args.query_id):
+			if (can_id == query_id):
 				if (command == "01"):
 					command_string = "REQUEST "
 				elif (command == '04'):
 					command_string = "OTHER_REQUEST"
 				else:
 					command_string = "UNKNOWN_MBE_MESSAGE"
-			elif (can_id == args.response_id):
+			elif (can_id == response_id):
 				if (command == '81'):
 					command_string = "RESPONSE"
 				elif (command == 'e4'):
@@ -211,28 +273,134 @@ def main():
 			isotp_string = ""
 		
 		if (output_log_line):
-			print(f"#[{i+1}]# {can_string}{isotp_string}:{output_data}")
+			writer.line(timestamp, f"#[{i+1}]# {can_string}{isotp_string}:{output_data}")
 
 		if (args.mbe):
-			if (can_id == args.query_id):
-				# If its a single frame then process it, otherwise wait for the final frame that has fragment_count set
+			if (can_id == query_id):
+				# If its a single frame then process it, otherwise wait for the final frame that completes the message
 				if(message_type == 0x00 or fragment_count > 0):
 					command = data[:2]
 					if(command == "01"): # A data request
-						pending_data_request_command = process_data_request_command(data, mappings)
+						request = bytes(payload)
+						if (not request in plans):
+							plans[request] = mbedecode.request_plan(request, mappings, variables)
+						pending_plan = plans[request]
+						pending_page = request[5] if len(request) >= 6 else None
 					elif(command == "04"):
 						logging.debug("This is a config request")
-			elif (can_id == args.response_id):
-				# If its a single frame then process it, otherwise wait for the final frame that has fragment_count set
+			elif (can_id == response_id):
+				# If its a single frame then process it, otherwise wait for the final frame that completes the message
 				if(message_type == 0x00 or fragment_count > 0):
 					command = data[:2]
-					if(command == "81"): # A data response
-						process_data_response(data, pending_data_request_command, variables)
+					if(command == "81" and pending_plan != None): # A data response
+						writer.response(timestamp, pending_page, decode_data_response(payload, pending_plan, variables))
 					elif(command == "e4"):
 						logging.debug("This is a config response")
 
-	cap.close()
+# Process pool worker for batch mode, returns a list of (timestamp, line, page, records) for a range of a capture
+# The variables are loaded once per worker process
+worker_variables = None
+
+def decode_range(filename, args, start, end, frame_number):
+	global worker_variables
+	if (worker_variables == None):
+		variables = load_mbe_variables(args.variables)
+		worker_variables = (variables, create_page_reverse_mapping(variables))
+
+	writer = CollectingWriter()
+	decode_capture(filename, args, worker_variables[0], worker_variables[1], writer, start, end, frame_number)
+	return writer.entries
+
+# Does a CAN frame start a new data request, if so nothing before it is needed to decode what follows
+def starts_data_request(can_id, frame, query_id):
+	if (can_id != query_id or len(frame) < 3):
+		return False
+	frame_type = frame[0] >> 4
+	return (frame_type == canisotp.single_frame and frame[1] == 0x01) or (frame_type == canisotp.first_frame and frame[2] == 0x01)
+
+# Decode many captures, splitting large ones into byte ranges, across a pool of processes
+# The output of every range is merged in timestamp order
+def decode_batch(filenames, args, writer):
+	query_id = int(args.query_id, 0)
+	shard_size = int(args.shard_size * 1024 * 1024)
+	shards = list()
+
+	for filename in filenames:
+		count = max(1, os.path.getsize(filename) // shard_size)
+		for start, end, frame_number in canpcap.split_capture(filename, count, lambda can_id, frame: starts_data_request(can_id, frame, query_id)):
+			shards.append((filename, start, end, frame_number))
+
+	logging.info(f"Decoding {len(filenames)} captures in {len(shards)} pieces with {args.jobs or os.cpu_count()} processes")
+
+	with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs or None) as executor:
+		futures = [executor.submit(decode_range, filename, args, start, end, frame_number) for filename, start, end, frame_number in shards]
+		results = [future.result() for future in futures]
+
+	for timestamp, line, page, records in heapq.merge(*results, key=lambda result: result[0] or 0.0):
+		if (line != None):
+			writer.line(timestamp, line)
+		else:
+			writer.response(timestamp, page, records)
+
+# The captures to decode, directories are searched (not recursively) for pcap and pcapng files
+def find_captures(inputs):
+	filenames = list()
+	for name in inputs:
+		if (os.path.isdir(name)):
+			for entry in sorted(os.listdir(name)):
+				path = os.path.join(name, entry)
+				if (os.path.isfile(path) and canpcap.capture_format(path) != None):
+					filenames.append(path)
+		else:
+			filenames.append(name)
+	return filenames
+
+def main():
+	# Setup and parse command line args
+	parser = argparse.ArgumentParser(prog='mbepcap2txt', description='Takes an pcap with ISOTP formatted MBE transactions and makes it human readable.')
+	parser.add_argument('--input',         '-i', nargs='+',        help='Input pcap, pcapng or candump filenames or directories of captures (- for candump on stdin)', required=True)
+	parser.add_argument('--can',           '-c',                   help='Display raw can data', action='store_true', default=False)
+	parser.add_argument('--isotp',         '-I',                   help='Display raw isotp data', action='store_true', default=False)
+	parser.add_argument('--mbe',           '-m',                   help='DON\'T Display mbe decoded data', action='store_false', default=True)
+	parser.add_argument('--variables',     '-v',                   help='Input MBE variables filename', required=True)
+	parser.add_argument('--query_id',      '-q',                   help='CAN query ID (default 0x0cbe1101)', default='0x0cbe1101')
+	parser.add_argument('--response_id',   '-r',                   help='CAN resdponse ID (default 0x0cbe0111)', default='0x0cbe0111')
+	parser.add_argument('--format',        '-F',                   help='Output format (default text)', choices=list(output_formats), default='text')
+	parser.add_argument('--output',        '-o',                   help='Output filename (default stdout, columnar needs a filename)')
+	parser.add_argument('--jobs',          '-j',                   help='Number of processes to decode with (default 1, 0 for one per CPU)', type=int, default=1)
+	parser.add_argument('--shard-size',    '-s',                   help='Split captures bigger than this many MB across processes (default 16)', type=float, default=16)
+	parser.add_argument('--loglevel',      '-l',                   help='Logging level to show', choices=['INFO','DEBUG','WARNING', 'ERROR', 'NONE'], default="INFO")
+	parser.add_argument('--logfile',       '-f',                   help='If set logging will be sent to this file')
+	parser.add_argument('--version',       '-V', action='version', version='%(prog)s '+version)
+
+	args = parser.parse_args()
+
+	logging_level = getattr(logging, args.loglevel, None)
+	logging.basicConfig(level=logging_level, filename=args.logfile, filemode='w')
+
+	if args.input == None:
+		parser.print_help()
+		exit()
+
+	variables = load_mbe_variables(args.variables)
+	mappings = create_page_reverse_mapping(variables)
+
+	filenames = find_captures(args.input)
+
+	try:
+		writer = output_formats[args.format](args.output)
+	except (ValueError, OSError) as e:
+		logging.error(f"Unable to open output: {e}")
+		exit()
+
+	if (len(filenames) == 1 and args.jobs == 1):
+		decode_capture(filenames[0], args, variables, mappings, writer)
+	elif ('-' in filenames):
+		logging.error("stdin can't be decoded in batch mode")
+	else:
+		decode_batch(filenames, args, writer)
 
+	writer.close()
 
 if __name__ == '__main__':
 	main()
\ No newline at end of file